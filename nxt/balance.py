@@ -0,0 +1,81 @@
+import re
+import math
+
+# Checking how accesses are spread over the replicas of a connector. Every connector
+# answers with "I am Nextensio agent <its name>", so each answer tells us exactly which
+# replica served it, and the counts per replica are checked with a chi-square test
+# against an even spread (which is what round robin loadbalancing should give)
+
+SERVED_BY = re.compile(r'I am Nextensio agent ([A-Za-z0-9_]+)')
+
+
+# The connector that served an answer, None if the answer doesnt say
+def served_by(text):
+    m = SERVED_BY.search(text)
+    if not m:
+        return None
+    return m[1]
+
+
+# Regularized upper incomplete gamma function Q(a, x), the series for small x and
+# the continued fraction for large x (numerical recipes gammq)
+def gamma_q(a, x):
+    if x <= 0:
+        return 1.0
+    scale = math.exp(-x + a * math.log(x) - math.lgamma(a))
+    if x < a + 1:
+        term = total = 1.0 / a
+        n = a
+        while abs(term) > abs(total) * 1e-15:
+            n += 1
+            term *= x / n
+            total += term
+        return max(0.0, 1.0 - total * scale)
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for i in range(1, 1000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        if abs(d) < tiny:
+            d = tiny
+        c = b + an / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return scale * h
+
+
+# How far the count furthest from an even spread of the counts is from it
+def deviation(counts):
+    if not counts:
+        return 0.0
+    expected = sum(counts) / len(counts)
+    return max(abs(c - expected) for c in counts)
+
+
+# Chi-square test of counts against an even spread, returns (statistic, p-value). A
+# small p-value means the counts are unlikely to come from an even spread
+def chi_square(counts):
+    total = sum(counts)
+    if len(counts) < 2 or total == 0:
+        return 0.0, 1.0
+    expected = total / len(counts)
+    statistic = sum((c - expected) ** 2 / expected for c in counts)
+    return statistic, gamma_q((len(counts) - 1) / 2.0, statistic / 2.0)
+
+
+# Whether the connectors that served the last few accesses (window) are all replicas
+# and each replica served within one access of an even share of the window
+def even(window, replicas):
+    counts = [window.count(r) for r in replicas]
+    if sum(counts) != len(window):
+        return False
+    return deviation(counts) <= 1
@@ -0,0 +1,57 @@
+import argparse
+import time
+from containers import kube_run
+from containers import KubeShell
+from exec_stats import percentile
+
+# Compare the per command latency of exec-ing into a pod with a new websocket
+# stream for every command (kube_run) against a single persistent shell
+# session (KubeShell). For example
+#
+# PYTHONPATH=$PYTHONPATH:. python3 bench_exec.py --context kind-gatewaytesta --pod nextensio-apod1
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    print("%-12s n=%d mean=%.1fms p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms" % (
+        name, len(samples), 1000 * sum(samples) / len(samples),
+        1000 * percentile(samples, 50), 1000 * percentile(samples, 90),
+        1000 * percentile(samples, 99), 1000 * max(samples)))
+
+
+def bench(count, run):
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--context', default='kind-gatewaytesta')
+    parser.add_argument('--namespace', default='nxt-nextensio')
+    parser.add_argument('--container', default='minion')
+    parser.add_argument('--pod', default='nextensio-apod1')
+    parser.add_argument('--cmd', default='cat /tmp/opa_attr_versions')
+    parser.add_argument('--count', type=int, default=100)
+    args = parser.parse_args()
+
+    # Warm up the api client and the pod index so that neither of the
+    # runs below pays for them
+    kube_run(args.context, args.namespace, args.container, args.pod, args.cmd)
+
+    samples = bench(args.count, lambda: kube_run(args.context, args.namespace,
+                                                 args.container, args.pod, args.cmd))
+    report("per-command", samples)
+
+    shell = KubeShell(args.context, args.namespace, args.container, args.pod)
+    shell.run(args.cmd)
+    samples = bench(args.count, lambda: shell.run(args.cmd))
+    shell.close()
+    report("persistent", samples)
+
+
+if __name__ == '__main__':
+    main()
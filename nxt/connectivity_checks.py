@@ -7,10 +7,32 @@ import sys
 import re
 import requests
 import time
+import threading
 import subprocess
-from containers import kube_get_pod
-from containers import docker_run
-import swagger_client
+import concurrent.futures
+import json
+import collections
+from containers import kube_wait_pod
+from containers import docker_exec
+from containers import run_many
+from containers import restart_many
+from containers import docker_exists
+from containers import docker_ip
+import consul
+import exec_stats
+import probe
+import balance
+import fakes
+import waits
+from opa import VERSIONS_FILE
+from opa import VERSIONED_POLICIES
+from waits import wait_for
+from waits import wait_all
+try:
+    import swagger_client
+except ImportError:
+    # Only good enough for running against the fake controller, see fakes.py
+    swagger_client = fakes
 
 # THE MOTTO: DO DETERMINISTIC TESTING. What it means is simple. Lets say we configure something
 # on the controller and we want to wait to ensure all the pods have got that config. One approach
@@ -21,9 +43,9 @@ import swagger_client
 # The above applies to code that WE WRITE and WE CONTROL. There are times when we have to check
 # for things in code we dont control. For example when we add a consul entry, it takes time to
 # propagate through kubernetes coredns. And we dont have any control or indication of how long it
-# takes or when its complete, so in those cases we do "check for dns, sleep 1 second if not ready",
-# that is not a great thing to do, if we could control every piece of code in the system we would
-# do it more predictably.
+# takes or when its complete, so in those cases we do "check for dns, check again a bit later if
+# not ready" (see waits.py), that is not a great thing to do, if we could control every piece of
+# code in the system we would do it more predictably.
 
 logger = logging.getLogger(__name__)
 
@@ -65,12 +87,18 @@ def clusterPod2Device(cluster, pod):
     return cluster + "_" + pod
 
 def runCmd(cmd):
+    start = time.perf_counter()
+    outcome = 'error'
     try:
         output = subprocess.check_output(cmd, shell=True)
+        outcome = 'ok'
         return output.decode()
     except:
         pass
         return ""
+    finally:
+        exec_stats.record('local', 'subprocess', exec_stats.command_class(cmd), outcome,
+                          time.perf_counter() - start)
 
 
 def podHasService(cluster, podname, xfor, xconnect):
@@ -94,80 +122,151 @@ def istioChecks(cluster, useragent, podnum, xfor, xconnect):
         pod = "apod" + str(podnum)
     else:
         pod = "cpod" + str(podnum)
-    podname = kube_get_pod(cluster, tenant, pod)
-    while not podname:
-        logger.info("Waiting to get podname for %s from cluster %s" %
-                    (pod, cluster))
-        time.sleep(1)
-        podname = kube_get_pod(cluster, tenant, pod)
-
-    while not podready:
-        logger.info("Waiting to describe pod %s from cluster %s, xfor %s, xconnect %s" %
-                    (podname, cluster, xfor, xconnect))
-        time.sleep(1)
-        podready = podHasService(cluster, podname, xfor, xconnect)
+    # kube_wait_pod blocks on the pod watch, so this is woken up as soon as the pod shows up
+    podname = wait_for(lambda: kube_wait_pod(cluster, tenant, pod, timeout=1),
+                       "podname for %s from cluster %s" % (pod, cluster), kind='pod')
+    wait_for(lambda: podHasService(cluster, podname, xfor, xconnect),
+             "istio rules of pod %s from cluster %s, xfor %s, xconnect %s" %
+             (podname, cluster, xfor, xconnect), kind='istio')
 
 # The dig lookup ensures that the service is reachable, and we also check
 # the TXT records from the dig result to ensure that the service is in the
-# proper pod that we expect
-def checkConsulDnsEntry(devices, cluster, svc, pod):
-    device = clusterPod2Device(cluster, "consul")
-    service = svc
-
-    while True:
-        value = devices[device].shell.execute('dig ' + service + '.nxt-' + TENANT + '.query.consul SRV').strip()
-        lines = value.splitlines()
-        cur = "None"
-        for l in lines:
-            m = re.search(r'\"NextensioPod:(.+)\"', l)
-            if m != None and m[1] == pod:
-                print("Found svc %s pod value %s in cluster %s" % (svc, m[0], cluster))
-                return
-            if m != None:
-                cur = m[1]
-        logger.info('Cluster %s, waiting for consul TXT record %s in pod %s, current %s' %
-                    (cluster, service, pod, cur))
-        time.sleep(1)
+# proper pod that we expect. All the services are looked up in one exec on the
+# consul pod, the output of each dig is preceded by a marker line with the
+# service name. Returns {service: [pods in its TXT records]}
+CONSUL_MARKER = "NXTSVC"
+NEXTENSIO_POD = re.compile(r'"NextensioPod:([^"]+)"')
+
+def consulDigCmd(services):
+    return 'for s in %s; do echo %s $s; dig $s.nxt-%s.query.consul SRV; done' % (
+        ' '.join(services), CONSUL_MARKER, TENANT)
 
+def consulServicePods(devices, cluster, services):
+    device = clusterPod2Device(cluster, "consul")
+    out = devices[device].shell.execute(consulDigCmd(services))
+    pods = {svc: [] for svc in services}
+    svc = None
+    for line in out.splitlines():
+        if line.startswith(CONSUL_MARKER + ' '):
+            svc = line.split()[1]
+            continue
+        m = NEXTENSIO_POD.search(line)
+        if m and svc in pods and m[1] not in pods[svc]:
+            pods[svc].append(m[1])
+    return pods
+
+# Block till a dig of the services shows one of the pods still missing, or timeout
+# seconds. The digs are repeated on the consul pod and the command is cut short as
+# soon as a missing pod shows up, so we hear of it without polling. Its only a wake
+# up, consulServicePods() then looks at what the services really have
+def consulPodShows(devices, cluster, missing, timeout):
+    device = clusterPod2Device(cluster, "consul")
+    pods = sorted(set(pod for svc in missing for pod in missing[svc]))
+    pattern = re.compile(r'"NextensioPod:(%s)"' % '|'.join(re.escape(pod) for pod in pods))
+    cmd = 'while true; do %s; sleep 0.2; done' % consulDigCmd(list(missing))
+    return devices[device].shell.execute_until(cmd, pattern, timeout)
+
+# Wait till the consul of each cluster has all the services of the connectors in that
+# cluster, in the pods we expect. The services are watched over the consul http api
+# (see consul.py) so we hear of a change as soon as consul has it, services the api
+# doesnt know of (or if the api cant be reached) are looked up with dig, blocking
+# on a repeated dig till a missing pod shows up between lookups. Either way only the
+# entries still missing are looked up, and the clusters are done in parallel
 def checkConsulDns(specs, devices):
-    services = []
-    cls = []
+    expected = {}
     for spec in specs:
-        if spec['agent'] != True:
-            if spec['service'] != '':
-                services.append({'name': spec['service'], 'cluster': spec['cluster'], 'pod': spec['pod']})
-            if spec['cluster'] not in cls:
-                cls.append(spec['cluster'])
-
-    for cluster in cls:
-        for service in services:
-            if cluster == service['cluster']:
-                checkConsulDnsEntry(devices, cluster, service['name'], service['pod'])
+        if spec['agent'] != True and spec['service'] != '':
+            pods = expected.setdefault(spec['cluster'], {}).setdefault(spec['service'], [])
+            if spec['pod'] not in pods:
+                pods.append(spec['pod'])
+
+    # The (pods consul has, pods still missing) of each service of each cluster
+    seen = {}
+
+    def consulReady(cluster):
+        missing = {svc: list(pods) for svc, pods in expected[cluster].items()}
+        watch = None
+        if not fakes.fake_mode():
+            shell = devices[clusterPod2Device(cluster, "consul")].shell
+            context, pod = shell.details()
+            watch = consul.consul_watch(context, shell.nxt['namespace'], pod)
+        generation = [None]
+        dug = [False]
+        current = {}
+        seen[cluster] = (current, missing)
+
+        def check():
+            found = {}
+            if watch:
+                found, generation[0] = watch.service_pods(list(missing), generation[0], timeout=1)
+            unknown = [svc for svc in missing if svc not in found]
+            if unknown:
+                if dug[0]:
+                    consulPodShows(devices, cluster, {svc: missing[svc] for svc in unknown}, 1)
+                dug[0] = True
+                found.update(consulServicePods(devices, cluster, unknown))
+            for svc in list(missing):
+                for pod in found[svc]:
+                    if pod in missing[svc]:
+                        print("Found svc %s pod value NextensioPod:%s in cluster %s" % (svc, pod, cluster))
+                        missing[svc].remove(pod)
+                if not missing[svc]:
+                    del missing[svc]
+                    current.pop(svc, None)
+                elif current.get(svc) != found[svc]:
+                    current[svc] = found[svc]
+                    print("Svc %s in cluster %s has pods %s, waiting for %s" % (svc, cluster, found[svc], missing[svc]))
+            return not missing
+        return check
+
+    if expected:
+        wait_all({cluster: consulReady(cluster) for cluster in expected}, "consul TXT records in cluster",
+                 kind='consul', workers=len(expected),
+                 state=lambda cluster: {svc: "has %s, waiting for %s" % (seen[cluster][0].get(svc), pods)
+                                        for svc, pods in seen[cluster][1].items()})
+
+# Wait till the controller onboarding log of every user and bundle in the specs says its
+# onboarded to the gateway and pod we expect. All of them are polled in parallel, and
+# how long each took since resetAgents restarted its container is printed as a table
 
 def checkOnboarding(specs):
+    expected = {}
     for spec in specs:
         if spec['agent'] == True:
             podnm = "nextensio-apod" + str(spec['pod'])
         else:
             podnm = spec['pod']
         gw = spec['cluster'] + ".nextensio.net"
-        checkUserOnboarding(spec['name'], gw, podnm)
-
-def checkUserOnboarding(uid, gw, podnm):
-    onblog = api_instance.get_user_onboard_log("superadmin", tenant, uid)
-    while onblog.result != "ok":
-        print('Onboarding log entry fetch failed, retrying ...')
-        time.sleep(1)
-        onblog = api_instance.get_user_onboard_log("superadmin", tenant, uid)
-    while onblog.gw != gw:
-        print('Waiting for %s to get onboarded, gw %s / %s' % (uid, gw, onblog.gw))
-        time.sleep(1)
-        onblog = api_instance.get_user_onboard_log("superadmin", tenant, uid)
-    while onblog.connectid != podnm:
-        print('Waiting for %s to get onboarded pod %s / %s' % (uid, podnm, onblog.connectid))
-        time.sleep(1)
-        onblog = api_instance.get_user_onboard_log("superadmin", tenant, uid)
-    print("%s onboarded for cluster %s pod %s" % (uid, gw, podnm))
+        expected[spec['name']] = (gw, podnm)
+
+    if not expected:
+        return
+    now = time.monotonic()
+    latency = {}
+    seen = {}
+
+    def onboarded(uid):
+        gw, podnm = expected[uid]
+        reset = restarted.get(uid, now)
+
+        def check():
+            try:
+                onblog = api_instance.get_user_onboard_log("superadmin", tenant, uid)
+            except Exception as e:
+                seen[uid] = "onboarding log entry fetch failed (%s)" % e
+                return False
+            seen[uid] = "result %s gw %s pod %s" % (onblog.result, onblog.gw, onblog.connectid)
+            if onblog.result != "ok" or onblog.gw != gw or onblog.connectid != podnm:
+                return False
+            latency[uid] = time.monotonic() - reset
+            return True
+        return check
+
+    wait_all({uid: onboarded(uid) for uid in expected}, "onboarding", kind='onboard',
+             workers=len(expected), state=lambda uid: "%s, want gw %s pod %s" % ((seen.get(uid),) + expected[uid]))
+    print("%-24s %-32s %-24s %s" % ("onboarded", "gateway", "pod", "seconds since restart"))
+    for uid, (gw, podnm) in sorted(expected.items(), key=lambda e: latency[e[0]]):
+        print("%-24s %-32s %-24s %.3f" % (uid, gw, podnm, latency[uid]))
 
 def parseVersions(versions):
     m = re.search(r'.*USER=([0-9]+)\.([0-9]+).*', versions)
@@ -210,42 +309,116 @@ def versionOk(current, previous, increments):
 # from the controller. This goes back to the motto of "deterministic testing" outlined at
 # the beginning of this file
 
-def getOpaVersion(devices, d, previous, increments):
-    versions = devices[d].shell.execute(
-        "cat /tmp/opa_attr_versions")
-    current = parseVersions(versions)
-    while not versionOk(current, previous, increments):
-        logger.info("Waiting for opa versions from device %s, cur %s, previous %s, incr %s" % (
-            d, current, previous, increments))
-        time.sleep(1)
-        versions = devices[d].shell.execute(
-            "cat /tmp/opa_attr_versions")
-        current = parseVersions(versions)
-
-    return current
-
+def getOpaVersion(devices, d):
+    versions = devices[d].shell.execute("cat " + VERSIONS_FILE)
+    return parseVersions(versions)
 
-def getAllOpaVersions(devices, specs, current, increments):
-    versions = {}
+# Wait till every device in the specs has its opa versions moved up by increments from
+# its own previous versions (previous is what this returned the last time, {} to just
+# read the versions). All the devices are polled in parallel, so we wait only as long
+# as the slowest pod. Returns the versions of each device
+def getAllOpaVersions(devices, specs, previous, increments):
+    names = []
     for spec in specs:
-        d = spec['device']
-        parse = getOpaVersion(devices, d, current, increments)
-        versions['ref'] = parse
+        if spec['device'] not in names:
+            names.append(spec['device'])
+
+    start = time.monotonic()
+    latency = {}
+    seen = {}
+
+    def converged(d):
+        def check():
+            current = getOpaVersion(devices, d)
+            seen[d] = current
+            if not versionOk(current, previous.get(d), increments):
+                return None
+            latency[d] = time.monotonic() - start
+            return current
+        return check
+
+    versions = wait_all({d: converged(d) for d in names}, "opa versions incr %s" % increments,
+                        kind='opa', workers=len(names),
+                        state=lambda d: "versions %s, previous %s" % (seen.get(d), previous.get(d)))
+    for d in names:
+        logger.info("Device %s opa versions %s, took %.3f seconds" % (d, versions[d], latency[d]))
     return versions
 
+# The version ledger. Every successful controller call that gets to opa bumps the version of
+# one attribute family (user/bundle/route/policy) in every pod, the create_* wrappers count
+# those bumps here. So instead of working out the increments by hand after configuring
+# something, take an opaBaseline(), push as much config as needed, and then opaSync() waits
+# till every pod has caught up with everything pushed since the baseline/last sync
+
+pushed = {'user': 0, 'bundle': 0, 'route': 0, 'policy': 0}
+synced = {}
+ledger_lock = threading.Lock()
+
+
+def ledgerBump(family):
+    with ledger_lock:
+        pushed[family] += 1
+
+
+def ledgerTake():
+    with ledger_lock:
+        increments = dict(pushed)
+        for family in pushed:
+            pushed[family] = 0
+    return increments
+
+
+def opaBaseline(devices, specs):
+    global synced
+    ledgerTake()
+    synced = getAllOpaVersions(devices, specs, {}, {'user': 0, 'bundle': 0, 'route': 0, 'policy': 0})
+    return synced
+
+
+def opaSync(devices, specs):
+    global synced
+    increments = ledgerTake()
+    synced = getAllOpaVersions(devices, specs, synced, increments)
+    return synced
+
 # TODO: Its hacky to be restarting an entire device using the shell/console object
 # of that device. We do that because the console object is all pyAts allows us to
 # override today. Need to find out if pyAts will allow us to override a device object
 # itself and if so we can add a device restart in our own custom device object
 
 
-def resetAgents(devices):
-    devices['nxt_agent1'].shell.restart()
-    devices['nxt_agent2'].shell.restart()
-    devices['nxt_default1'].shell.restart()
-    devices['nxt_default2'].shell.restart()
-    devices['nxt_kismis_ONE'].shell.restart()
-    devices['nxt_kismis_TWO'].shell.restart()
+# When resetAgents last restarted the container(s) of each user/bundle
+restarted = {}
+RESET_WORKERS = 16
+RESET_TIMEOUT = 120
+
+# Restart the containers of the users/bundles in specs (or all of them if no specs), all
+# at once, and wait for each to be running again. The containers are the docker devices
+# of the testbed, the user/bundle of a container is the nxt_id in its custom section.
+# Whether the agent/connector in the container is ready is up to checkOnboarding
+def resetAgents(devices, specs=None):
+    names = None
+    if specs != None:
+        names = [spec['name'] for spec in specs]
+    bounce = []
+    for d in devices:
+        if devices[d].type != 'docker':
+            continue
+        nxt_id = devices[d].custom.get('nxt_id')
+        if nxt_id == None or (names != None and nxt_id not in names):
+            continue
+        restarted[nxt_id] = time.monotonic()
+        bounce.append(d)
+
+    results = restart_many(devices, bounce, RESET_WORKERS, RESET_TIMEOUT)
+    failed = []
+    for d, result in results.items():
+        if result['error'] != None:
+            failed.append("%s (%s)" % (d, result['error']))
+        else:
+            logger.info("Device %s restarted and running in %.3f seconds" % (d, result['output']))
+    if failed:
+        quit_error("Restart failed for %s" % ', '.join(failed))
 
 def quit_error(text):
     print(text)
@@ -253,37 +426,11 @@ def quit_error(text):
 
 # Ensure public and private access is successul
 def publicAndPvtPass(kwargs, agent1, agent2):
-    proxy, text, err = proxyGet(kwargs, 'nxt_agent1', 'https://foobar.com',
-                                "I am Nextensio agent nxt_default", None) 
-    if err == True:
-        quit_error(text)
-    if proxy != True:
-        print("agent1 default internet access fail")
-        quit_error(text)
-
-    proxy, text, err = proxyGet(kwargs, 'nxt_agent2', 'https://foobar.com',
-                                "I am Nextensio agent nxt_default", None) 
-    if err == True:
-        quit_error(text)
-    if proxy != True:
-        print("agent2 default internet fail")
-        quit_error(text)
-
-    proxy, text, err = proxyGet(kwargs, 'nxt_agent1', 'https://kismis.org',
-                                "I am Nextensio agent nxt_kismis_" + agent1, None) 
-    if err == True:
-        quit_error(text)
-    if proxy != True:
-        print("agent1 kismis_%s fail" % agent1)
-        quit_error(text)
-
-    proxy, text, err = proxyGet(kwargs, 'nxt_agent2', 'https://kismis.org',
-                                "I am Nextensio agent nxt_kismis_" + agent2, None) 
-    if err == True:
-        quit_error(text)
-    if proxy != True:
-        print("agent2 kismis_%s fail" % agent2)
-        quit_error(text)
+    checkReachability(kwargs, [
+        {'agent': 'nxt_agent1', 'url': 'https://foobar.com', 'body': "I am Nextensio agent nxt_default"},
+        {'agent': 'nxt_agent2', 'url': 'https://foobar.com', 'body': "I am Nextensio agent nxt_default"},
+        {'agent': 'nxt_agent1', 'url': 'https://kismis.org', 'body': "I am Nextensio agent nxt_kismis_" + agent1},
+        {'agent': 'nxt_agent2', 'url': 'https://kismis.org', 'body': "I am Nextensio agent nxt_kismis_" + agent2}])
 
 # Ensure public access fails
 
@@ -291,38 +438,18 @@ def publicAndPvtPass(kwargs, agent1, agent2):
 def publicFail(kwargs):
     # Exit code 35 means the curl command timed out, which is what we really
     # expect here
-    proxy, text, err = proxyGet(kwargs, 'nxt_agent1', 'https://foobar.com',
-                                "I am Nextensio agent nxt_default", 35) 
-    if err == True:
-        quit_error(text)
-    if proxy == True:
-        quit_error("agent1 default internet access works!")
-
-    # Exit code 28 means the curl command timed out, which is what we really
-    # expect here
-    proxy, text, err = proxyGet(kwargs, 'nxt_agent2', 'https://foobar.com',
-                                "I am Nextensio agent nxt_default", 35) 
-    if err == True:
-        quit_error(text)
-    if proxy == True:
-        quit_error("agent2 default internet works!")
+    checkReachability(kwargs, [
+        {'agent': 'nxt_agent1', 'url': 'https://foobar.com', 'body': "I am Nextensio agent nxt_default", 'exit': 35},
+        {'agent': 'nxt_agent2', 'url': 'https://foobar.com', 'body': "I am Nextensio agent nxt_default", 'exit': 35}])
 
 def config_policy():
     with open('policy.AccessPolicy','r') as file:
         rego = file.read()
-        ok = create_policy('AccessPolicy', rego)
-        while not ok:
-            logger.info('Access Policy creation failed, retrying ...')
-            time.sleep(1)
-            ok = create_policy('AccessPolicy', rego)
+        wait_for(lambda: create_policy('AccessPolicy', rego), 'Access Policy creation', kind='controller')
         
     with open('policy.RoutePolicy','r') as file:
         rego = file.read()
-        ok = create_policy('RoutePolicy', rego)
-        while not ok:
-            logger.info('Route Policy creation failed, retrying ...')
-            time.sleep(1)
-            ok = create_policy('RoutePolicy', rego)
+        wait_for(lambda: create_policy('RoutePolicy', rego), 'Route Policy creation', kind='controller')
 
         
 def config_routes(tag1, tag2):
@@ -334,11 +461,7 @@ def config_routes(tag1, tag2):
                        "category":["employee"], "type":["manager"], "IClvl": 1, "mlvl": 1 }
 		      ]
                 }
-    ok = create_host_attr(routejson)
-    while not ok:
-        logger.info('Route creation failed, retrying ...')
-        time.sleep(1)
-        ok = create_host_attr(routejson)
+    wait_for(lambda: create_host_attr(routejson), 'Route creation', kind='controller')
 
 
 def config_user_attr(level1, level2):
@@ -348,42 +471,49 @@ def config_user_attr(level1, level2):
     user2attrjson = {"uid":USER2, "category":"employee", "type":"manager", "level":level2,
                      "dept":["ABU","BBU"], "team":["engineering","sales"],
                      "location": "California", "ostype": "Linux", "osver": 20.04 }
-    ok = create_user_attr(user1attrjson, USER1)
-    while not ok:
-        logger.info('UserAttr test1 config failed, retrying ...')
-        time.sleep(1)
-        ok = create_user_attr(user1attrjson, USER1)
-
-    ok = create_user_attr(user2attrjson, USER2)
-    while not ok:
-        logger.info('UserAttr test2 config failed, retrying ...')
-        time.sleep(1)
-        ok = create_user_attr(user2attrjson, USER2)
-
-
-def config_user(user, service, gateway, pod):
-    ok = create_user(user, user, pod, gateway)
-    while not ok:
-        logger.info('User %s updation failed, retrying ...' % user)
-        time.sleep(1)
-        ok = create_user(user, user, pod, gateway)
-
-
-def config_bundle(bundle, service, gateway, pod):
-    ok = create_bundle(bundle, bundle, [service], pod, gateway, 2)
-    while not ok:
-        logger.info('Bundle %s updation failed, retrying ...' % bundle)
-        time.sleep(1)
-        ok = create_bundle(bundle, bundle, [service], pod, gateway, 2)
+    wait_for(lambda: create_user_attr(user1attrjson, USER1), 'UserAttr test1', kind='controller')
+
+    wait_for(lambda: create_user_attr(user2attrjson, USER2), 'UserAttr test2', kind='controller')
+
+
+# Placements are pushed to the controller at most PUSH_WORKERS at a time, and all the
+# pushes of one pushPlacements share PUSH_RETRIES retries between them, so a controller
+# that keeps failing fails the testcase setup instead of being retried forever
+PUSH_WORKERS = 8
+PUSH_RETRIES = 30
+
+def config_placement(spec):
+    gateway = spec['cluster'] + '.nextensio.net'
+    if spec['agent'] == True:
+        return create_user(spec['name'], spec['name'], spec['pod'], gateway)
+    return create_bundle(spec['name'], spec['name'], [spec['service']], spec['pod'], gateway, 2)
+
+# Push the user/bundle of every spec, if a name is in the specs more than once its
+# last spec is what gets pushed. Returns the run_many result of each name
+def pushPlacements(specs):
+    placements = {}
+    for spec in specs:
+        placements[spec['name']] = spec
+    budget = {'retries': PUSH_RETRIES}
+    lock = threading.Lock()
+
+    def push(spec):
+        interval = waits.FIRST_INTERVAL
+        while not config_placement(spec):
+            with lock:
+                if budget['retries'] == 0:
+                    raise Exception("out of retries")
+                budget['retries'] -= 1
+            logger.info('Placement of %s failed, retrying ...' % spec['name'])
+            interval = waits.backoff(interval, time.monotonic() + waits.MAX_INTERVAL)
+        return True
+
+    return run_many({name: (push, spec) for name, spec in placements.items()}, PUSH_WORKERS)
 
 def config_default_bundle_attr(depts, teams):
     bundleattrjson = {"bid":CNCTR3, "dept":depts,
                        "team":teams, "IC":10, "manager":10, "nonemployee":"allow"}
-    ok = create_bundle_attr(bundleattrjson)
-    while not ok:
-        logger.info('BundleAttr bundle default config failed, retrying ...')
-        time.sleep(1)
-        ok = create_bundle_attr(bundleattrjson)
+    wait_for(lambda: create_bundle_attr(bundleattrjson), 'BundleAttr bundle default', kind='controller')
 
 
 # If testing in webproxy mode, the curl command will open a connection to port 8181
@@ -395,26 +525,243 @@ def webProxyTestMode(kwargs):
         return False
     return True
 
-# Get a URL via a proxy
-def proxyGet(kwargs, agent, url, expected, expected_exit):
+# Each agent has its own probe container curl_<agent> (see sanity_jobs.py) with its
+# default route already pointing to the agent, which runs the probe daemon (probe.py).
+# All the probes through an agent go to its daemon in one batch. If the daemon cant be
+# reached we exec curl in the probe container instead (slower, but the same access), and
+# if there is no probe container for an agent we fall back to the shared curl container
+probes = {}
+daemons = {}
+PROBE_WORKERS = 16
+# In l3 mode the shared curl container has its default route changed around each
+# access, so only one of those accesses can be in flight at a time
+shared_curl_lock = threading.Lock()
+
+def probeContainer(agent):
+    if agent not in probes:
+        cname = "curl_" + agent
+        if docker_exists(cname):
+            probes[agent] = cname
+        else:
+            probes[agent] = None
+    return probes[agent]
+
+def probeDaemon(cname):
+    if cname not in daemons:
+        daemons[cname] = docker_ip(cname)
+    return daemons[cname]
+
+def proxyOf(kwargs, agent):
+    if webProxyTestMode(kwargs):
+        return "http://" + os.getenv(agent) + ":8181"
+    return None
+
+# A probe result is what the daemon gives back for a probe, {'exit': the curl exit code,
+# 'body': the answer (or what went wrong), 'time': seconds taken}. exit is None if the
+# access couldnt even be tried (docker exec failed etc..). This turns it into the usual
+# (proxy, text, err) of proxyGet(), with the same checks as docker_run() on the exit code
+def probeResult(result, expected, expected_exit):
+    exit_code = result['exit']
+    if exit_code == None:
+        return False, result['body'], True
+    if exit_code != 0 and (expected_exit == None or expected_exit != exit_code):
+        return False, "probe fail exit_code %s" % exit_code, True
+    if expected not in result['body']:
+        return False, result['body'], False
+    return True, result['body'], False
+
+# Access a URL via an agent with a docker exec of curl, returns a probe result
+def probeExec(kwargs, agent, url):
+    start = time.monotonic()
     try:
-        if webProxyTestMode(kwargs):
-            env = {"https_proxy": "http://" + os.getenv(agent) + ":8181"}
-            text, err = docker_run("curl", "curl --silent --connect-timeout 5 --max-time 5 -k %s" % url, expected_exit, environment=env)
-            if err == True:
-                return False, text, err
+        cname = probeContainer(agent)
+        proxy = proxyOf(kwargs, agent)
+        if cname:
+            cmd = "curl --silent --connect-timeout 5 --max-time 5"
+            if proxy:
+                cmd += " --proxy " + proxy
+            output, exit_code = docker_exec(cname, "%s -k %s" % (cmd, url))
+        elif proxy:
+            env = {"https_proxy": proxy}
+            output, exit_code = docker_exec("curl", "curl --silent --connect-timeout 5 --max-time 5 -k %s" % url, env)
         else:
-            docker_run("curl", "route add default gw %s" % os.getenv(agent), None)
-            text, err = docker_run("curl", "curl --silent --connect-timeout 5 --max-time 5 -k %s" % url, expected_exit)
-            docker_run("curl", "route del default gw %s" % os.getenv(agent), None)
-            if err == True:
-                return False, text, err
+            # Route via the agent, curl and remove the route again all in one docker exec
+            gw = os.getenv(agent)
+            cmd = "route add default gw %s; curl --silent --connect-timeout 5 --max-time 5 -k %s; " \
+                  "rc=$?; route del default gw %s; exit $rc" % (gw, url, gw)
+            with shared_curl_lock:
+                output, exit_code = docker_exec("curl", ["sh", "-c", cmd])
+        body = output.decode("utf-8", "replace")
     except Exception as e:
-        pass
-        return False, "Exception %s" % e, True
-    if expected not in text:
-        return False, text, False
-    return True, "", False
+        exit_code, body = None, "Exception %s" % e
+    return {'exit': exit_code, 'body': body, 'time': time.monotonic() - start}
+
+# Do many accesses at once, accesses is a list of (agent, url) and the probe result of
+# each is returned in the same order. With reuse the probe daemons keep their
+# connections open across probes
+def probeAll(kwargs, accesses, reuse=False):
+    results = [None] * len(accesses)
+    batches = {}
+    for i, (agent, url) in enumerate(accesses):
+        cname = probeContainer(agent)
+        if cname and probeDaemon(cname):
+            batches.setdefault(cname, []).append(i)
+
+    def runBatch(cname):
+        specs = [{'url': accesses[i][1], 'proxy': proxyOf(kwargs, accesses[i][0])} for i in batches[cname]]
+        try:
+            replies = probe.probe_batch(daemons[cname], specs, reuse)
+        except Exception as e:
+            logger.info("Probe daemon of %s failed (%s), exec-ing probes instead" % (cname, e))
+            daemons[cname] = None
+            return
+        for i, reply in zip(batches[cname], replies):
+            outcome = 'ok' if reply['exit'] == 0 else 'error'
+            exec_stats.record(cname, 'probe', accesses[i][1], outcome, reply['time'])
+            results[i] = reply
+
+    if not accesses:
+        return results
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(PROBE_WORKERS, len(accesses))) as pool:
+        list(pool.map(runBatch, list(batches)))
+        rest = [i for i in range(len(accesses)) if results[i] == None]
+        for i, result in zip(rest, pool.map(lambda i: probeExec(kwargs, *accesses[i]), rest)):
+            results[i] = result
+    return results
+
+# Do many proxy gets at once, gets is a list of (agent, url, expected, expected_exit)
+# and the (proxy, text, err) of each is returned in the same order, text is the answer
+# or what went wrong
+def proxyGetMany(kwargs, gets, reuse=False):
+    results = probeAll(kwargs, [(agent, url) for agent, url, expected, expected_exit in gets], reuse)
+    return [probeResult(result, get[2], get[3]) for result, get in zip(results, gets)]
+
+# The reachability matrix. Each cell is an access via an agent to a url and what we
+# expect of it, cell['body'] is the text the answer should have, and if cell['exit']
+# is set the access should instead fail with that curl exit code (or at least not get
+# an answer with that text). A cell that fails with any other exit code is an error,
+# not a "not reached". All cells are probed at once, and every cell gets back 'ok',
+# the curl 'exit_code', what was 'observed' and the 'time' it took
+def reachability(kwargs, cells):
+    results = probeAll(kwargs, [(c['agent'], c['url']) for c in cells])
+    matrix = []
+    for cell, result in zip(cells, results):
+        exit_code = result['exit']
+        reached = exit_code == 0 and cell['body'] in result['body']
+        if exit_code == None:
+            ok, observed = False, "error %s" % result['body']
+        elif exit_code != 0 and exit_code != cell.get('exit'):
+            ok, observed = False, "error exit %d" % exit_code
+        elif cell.get('exit') == None:
+            ok = reached
+            observed = "reached" if reached else result['body'] if exit_code == 0 else "exit %d" % exit_code
+        else:
+            ok = not reached
+            observed = "reached" if reached else "not reached, exit %d" % exit_code
+        matrix.append(dict(cell, ok=ok, exit_code=exit_code, observed=observed.strip(), time=result['time']))
+    return matrix
+
+def expectedOf(cell):
+    if cell.get('exit') != None:
+        return "exit %d" % cell['exit']
+    return cell['body']
+
+# Probe all the cells, print the whole matrix and fail if any cell is not as expected
+def checkReachability(kwargs, cells):
+    matrix = reachability(kwargs, cells)
+    print("%-12s %-20s %-40s %-8s %s" % ("agent", "url", "expected", "ms", "observed"))
+    for cell in matrix:
+        print("%-12s %-20s %-40s %-8.1f %s%s" % (cell['agent'], cell['url'], expectedOf(cell),
+              1000 * cell['time'], "" if cell['ok'] else "MISMATCH ", cell['observed'][:80]))
+    failed = ["%s %s" % (cell['agent'], cell['url']) for cell in matrix if not cell['ok']]
+    if failed:
+        quit_error("Reachability failed for %s" % ', '.join(failed))
+
+def proxyGet(kwargs, agent, url, expected, expected_exit):
+    return proxyGetMany(kwargs, [(agent, url, expected, expected_exit)])[0]
+
+# Load runs (only with NXT_LOAD set), a baseline of the rps, error rate and latency of
+# each agent to connector path. The probe daemon of the agent sends the same access
+# over and over from NXT_LOAD_CONCURRENCY threads, at NXT_LOAD_RATE accesses a second
+# (0 for as fast as they go), for NXT_LOAD_DURATION seconds. Each path is loaded on
+# its own, once per mode in NXT_LOAD_MODES (l3 and/or webproxy). Without a daemon the
+# accesses are exec-ed, and then the latencies include the docker exec, so every path
+# says which way (via) it was loaded. The summaries are printed and written to
+# load.json in NXT_STATS_DIR
+def loadSettings():
+    return {'concurrency': int(os.getenv('NXT_LOAD_CONCURRENCY', 8)),
+            'rate': float(os.getenv('NXT_LOAD_RATE', 0)),
+            'duration': float(os.getenv('NXT_LOAD_DURATION', 10))}
+
+# The kwargs that put proxyOf() in the given mode
+def modeArgs(kwargs, mode):
+    args = {k: v for k, v in kwargs.items() if k != 'WebProxy'}
+    if mode == 'webproxy':
+        args['WebProxy'] = True
+    return args
+
+# One exec-ed load access, a probe result like the daemon gives
+def loadSend(kwargs, agent, url, expected):
+    def send(spec):
+        result = probeExec(kwargs, agent, url)
+        # An access that couldnt be run at all counts as a failure with exit -1
+        exit_code = -1 if result['exit'] == None else result['exit']
+        return dict(result, exit=exit_code, match=exit_code == 0 and expected in result['body'])
+    return send
+
+# Load one path, returns the raw result of probe.run_load() and whether it was
+# loaded via the daemon or via exec
+def loadPath(kwargs, mode, agent, url, expected, settings):
+    args = modeArgs(kwargs, mode)
+    spec = dict(settings, url=url, proxy=proxyOf(args, agent), expected=expected)
+    cname = probeContainer(agent)
+    if cname and probeDaemon(cname):
+        try:
+            return probe.load_run(daemons[cname], spec), 'daemon'
+        except Exception as e:
+            logger.info("Probe daemon of %s failed (%s), exec-ing the load instead" % (cname, e))
+    return probe.run_load(spec, loadSend(args, agent, url, expected)), 'exec'
+
+# The rps, error rate and latency percentiles (in seconds) of a load result
+def loadSummary(result):
+    latencies = result['latencies']
+    sent, elapsed = result['sent'], result['elapsed']
+    return {'sent': sent, 'ok': len(latencies), 'elapsed': elapsed,
+            'rps': sent / elapsed if elapsed > 0 else 0,
+            'error_rate': (sent - len(latencies)) / sent if sent else 0,
+            'failures': result['failures'],
+            'p50': exec_stats.percentile(latencies, 50), 'p90': exec_stats.percentile(latencies, 90),
+            'p99': exec_stats.percentile(latencies, 99), 'max': latencies[-1] if latencies else None}
+
+def ms(seconds):
+    if seconds == None:
+        return "-"
+    return "%.1f" % (1000 * seconds)
+
+# paths is a list of (agent, connector, url, expected), fails if a path got no
+# good answers at all
+def runLoad(kwargs, paths):
+    settings = loadSettings()
+    report = []
+    for mode in os.getenv('NXT_LOAD_MODES', 'l3,webproxy').split(','):
+        for agent, connector, url, expected in paths:
+            result, via = loadPath(kwargs, mode, agent, url, expected, settings)
+            report.append(dict(loadSummary(result), mode=mode, via=via, agent=agent,
+                               connector=connector, url=url))
+
+    print("%-9s %-7s %-12s %-10s %7s %9s %7s %8s %8s %8s" %
+          ("mode", "via", "agent", "connector", "sent", "rps", "errors", "p50 ms", "p90 ms", "p99 ms"))
+    for r in report:
+        print("%-9s %-7s %-12s %-10s %7d %9.1f %6.1f%% %8s %8s %8s" %
+              (r['mode'], r['via'], r['agent'], r['connector'], r['sent'], r['rps'],
+               100 * r['error_rate'], ms(r['p50']), ms(r['p90']), ms(r['p99'])))
+    with open(os.path.join(os.getenv('NXT_STATS_DIR', '.'), 'load.json'), 'w') as f:
+        json.dump({'settings': settings, 'paths': report}, f, indent=2)
+
+    dead = ["%s %s -> %s" % (r['mode'], r['agent'], r['connector']) for r in report if r['ok'] == 0]
+    if dead:
+        quit_error("No good answers under load for %s" % ', '.join(dead))
+    return report
 
 # Basic access sanity checks public and private URL access, in some cases
 # the accesses are expected to succeed and in some cases its expected to fail
@@ -424,157 +771,168 @@ def proxyGet(kwargs, agent, url, expected, expected_exit):
 
 
 def basicAccessSanity(kwargs, specs, devices):
-    increments = {'user': 0, 'bundle': 0, 'route': 0, 'policy': 0}
     logger.info('STEP1')
-    versions = getAllOpaVersions(devices, specs, {}, increments)
+    opaBaseline(devices, specs)
     config_policy()
     config_routes('v1', 'v2')
     config_user_attr(50, 50)
     config_default_bundle_attr(['ABU,BBU'], ['engineering', 'sales'])
-    increments = {'user': 2, 'bundle': 1, 'route': 1, 'policy': 1}
-    versions = getAllOpaVersions(devices, specs, versions['ref'], increments)
+    opaSync(devices, specs)
     # Test public and private access via default routing setup
     publicAndPvtPass(kwargs, "ONE", "TWO")
 
     logger.info('STEP2')
     # Switch routes and ensure private route http get has switched
     config_routes('v2', 'v1')
-    increments = {'user': 0, 'bundle': 0, 'route': 1, 'policy': 0}
-    versions = getAllOpaVersions(devices, specs, versions['ref'], increments)
+    opaSync(devices, specs)
     publicAndPvtPass(kwargs, "TWO", "ONE")
 
     logger.info('STEP3')
     # Reduce the level of the user and ensure user cant access public
     config_user_attr(5, 5)
-    increments = {'user': 2, 'bundle': 0, 'route': 0, 'policy': 0}
-    versions = getAllOpaVersions(devices, specs, versions['ref'], increments)
+    opaSync(devices, specs)
     publicFail(kwargs)
 
     logger.info('STEP4')
     # Increase the level of the user and ensure user can again access public
     config_user_attr(50, 50)
-    increments = {'user': 2, 'bundle': 0, 'route': 0, 'policy': 0}
-    versions = getAllOpaVersions(devices, specs, versions['ref'], increments)
+    opaSync(devices, specs)
     publicAndPvtPass(kwargs, "TWO", "ONE")
 
     logger.info('STEP5')
     # Change the teams of the bundle and ensure that user cant access default internet
     config_default_bundle_attr(['abcd,efgh'], ['abcd', 'efgh'])
-    increments = {'user': 0, 'bundle': 1, 'route': 0, 'policy': 0}
-    versions = getAllOpaVersions(devices, specs, versions['ref'], increments)
+    opaSync(devices, specs)
     publicFail(kwargs)
 
     logger.info('STEP6')
     # Restore the bundle attributes and ensure default internet works again
     config_default_bundle_attr(['ABU,BBU'], ['engineering', 'sales'])
-    increments = {'user': 0, 'bundle': 1, 'route': 0, 'policy': 0}
-    versions = getAllOpaVersions(devices, specs, versions['ref'], increments)
+    opaSync(devices, specs)
     publicAndPvtPass(kwargs, "TWO", "ONE")
 
-# Access default internet four times, ensuring that the accesses are split across
-# two connectors (since by default we have round robin loadbalancing)
-def basicLoadbalancing(kwargs, specs, devices):
-    # Set routes/policies all back to default
-    increments = {'user': 0, 'bundle': 0, 'route': 0, 'policy': 0}
-    logger.info('STEP1')
-    versions = getAllOpaVersions(devices, specs, {}, increments)
+# How many accesses checkBalance makes, the significance level of the chi-square test
+# of their spread over the replicas, and by how many accesses a replica can be off an
+# even spread on top of that (round robin should get every replica its exact share)
+LB_REQUESTS = int(os.getenv('NXT_LB_REQUESTS', 64))
+LB_ALPHA = float(os.getenv('NXT_LB_ALPHA', 0.05))
+LB_TOLERANCE = float(os.getenv('NXT_LB_TOLERANCE', 2))
+
+# The replicas of a user/bundle, the docker devices of the testbed with it as nxt_id
+def replicasOf(devices, nxt_id):
+    return sorted([d for d in devices if devices[d].type == 'docker' and
+                   devices[d].custom.get('nxt_id') == nxt_id])
+
+# The loadbalancing needs some warmup, with the first few accesses going un-loadbalanced
+# before it starts loadbalancing (not sure why, see basicLoadbalancing). Rather than a
+# fixed number of warmup accesses, we access one at a time till the connectors that
+# served the last NXT_WARMUP_WINDOW accesses are spread evenly over the replicas (each
+# within one access of its share), failing if that doesnt happen in NXT_WARMUP_MAX
+# accesses. How many accesses and how long each warmup took is written to
+# warmups.json at the end of the run
+WARMUP_WINDOW = int(os.getenv('NXT_WARMUP_WINDOW', 8))
+WARMUP_MAX = int(os.getenv('NXT_WARMUP_MAX', 64))
+warmups = []
+
+def warmUp(kwargs, agent, url, replicas):
+    start = time.monotonic()
+    window = collections.deque(maxlen=WARMUP_WINDOW)
+    sent = 0
+    stable = False
+    while not stable and sent < WARMUP_MAX:
+        proxy, text, err = proxyGet(kwargs, agent, url, "I am Nextensio agent", None)
+        sent += 1
+        if proxy != True:
+            print("%s warmup access to %s fail" % (agent, url))
+            quit_error(text)
+        window.append(balance.served_by(text))
+        stable = len(window) == WARMUP_WINDOW and balance.even(list(window), replicas)
+    elapsed = time.monotonic() - start
+    warmups.append({'agent': agent, 'url': url, 'replicas': replicas, 'accesses': sent,
+                    'time': elapsed, 'stable': stable})
+    exec_stats.record(agent, 'warmup', url, 'ok' if stable else 'timeout', elapsed)
+    if not stable:
+        quit_error("Loadbalancing of %s via %s not steady after %d accesses, last %s" %
+                   (url, agent, sent, list(window)))
+    logger.info("Warmup of %s via %s took %d accesses, %.3f seconds" % (url, agent, sent, elapsed))
+    return sent
+
+def dumpWarmups():
+    with open(os.path.join(os.getenv('NXT_STATS_DIR', '.'), 'warmups.json'), 'w') as f:
+        json.dump(warmups, f, indent=2)
+
+# Access url via agent count times all at once, and check that every access is served
+# by one of the replicas and that the accesses are spread evenly over the replicas: the
+# chi-square test of the counts has to pass at LB_ALPHA (see balance.py) and no replica
+# can be more than LB_TOLERANCE accesses off its share. Returns the count of accesses
+# each replica served
+def checkBalance(kwargs, agent, url, replicas, count):
+    gets = [(agent, url, "I am Nextensio agent", None)] * count
+    served = {r: 0 for r in replicas}
+    failed = []
+    strays = []
+    for proxy, text, err in proxyGetMany(kwargs, gets):
+        if proxy != True:
+            failed.append(text.strip())
+            continue
+        connector = balance.served_by(text)
+        if connector in served:
+            served[connector] += 1
+        else:
+            strays.append(connector)
+    if failed:
+        quit_error("%d of %d accesses to %s via %s failed: %s" % (len(failed), count, url, agent, failed[0]))
+    if strays:
+        quit_error("Accesses to %s served by %s, not one of %s" % (url, sorted(set(strays)), replicas))
+    counts = list(served.values())
+    statistic, pvalue = balance.chi_square(counts)
+    logger.info("Accesses to %s via %s per replica %s, chi-square %.2f p-value %.4f" %
+                (url, agent, served, statistic, pvalue))
+    if pvalue < LB_ALPHA:
+        quit_error("Accesses to %s not loadbalanced: %s (chi-square p-value %.2g below %g)" %
+                   (url, served, pvalue, LB_ALPHA))
+    if balance.deviation(counts) > LB_TOLERANCE:
+        quit_error("Accesses to %s not loadbalanced: %s, more than %g off an even spread" %
+                   (url, served, LB_TOLERANCE))
+    return served
+
+# Set routes/policies all back to default, agent1 goes to kismis ONE and agent2 to
+# kismis TWO
+def defaultPolicies(devices, specs):
+    opaBaseline(devices, specs)
     config_policy()
     config_routes('v1', 'v2')
     config_user_attr(50, 50)
     config_default_bundle_attr(['ABU,BBU'], ['engineering', 'sales'])
-    increments = {'user': 2, 'bundle': 1, 'route': 1, 'policy': 1}
-    versions = getAllOpaVersions(devices, specs, versions['ref'], increments)
+    opaSync(devices, specs)
+
+# Access default internet many times, ensuring that the accesses are split evenly
+# across the default connectors (since by default we have round robin loadbalancing)
+def basicLoadbalancing(kwargs, specs, devices):
+    logger.info('STEP1')
+    defaultPolicies(devices, specs)
 
     # TODO: The loadbalancing seems to need some warmup with initial few accesses
     # going un-loadbalanced before it starts loadbalancing - not sure why that is
     # the case, this needs to be debugged and understood, the below just hacks around
-    # to do a few warmup loads 
-    for i in range(16):
-        proxy, text, err = proxyGet(kwargs, 'nxt_agent1', 'https://foobar.com',
-                                    "I am Nextensio agent nxt_default", None) 
-        if err == True:
-            quit_error(text)
-        if proxy != True:
-            print("agent1 default fail")
-            quit_error(text)
-
-    def1 = 0
-    def2 = 0
-    def1_new = 0
-    def2_new = 0
-    try:
-        out, err = docker_run("nxt_default1", "curl http://127.0.0.1/server-status?auto", None)
-        m = re.search(r'Total Accesses: ([0-9]+)', out)
-        if not m:
-            quit_error("Bad lighthttpd stats %s" % out)
-        def1 = int(m[1])
-        out, err = docker_run("nxt_default2", "curl http://127.0.0.1/server-status?auto", None)
-        m = re.search(r'Total Accesses: ([0-9]+)', out)
-        if not m:
-            quit_error("Bad lighthttpd stats %s" % out)
-        def2 = int(m[1])
-    except Exception as e:
-        quit_error("Exception %s" % e)
-
-    # This should trigger four accesses to default1 and four to default2
-    for i in range(8):
-        proxy, text, err = proxyGet(kwargs, 'nxt_agent1', 'https://foobar.com',
-                                    "I am Nextensio agent nxt_default", None) 
-        if err == True:
-            quit_error(text)
-        if proxy != True:
-            print("agent1 default internet access fail")
-            quit_error(text)
-
-    # Access kismis multiple times from agent1 and agent2 and ensure
-    # it works. kismis has two replicas but only one connector, so here
-    # we are trying to ensure that the kismis access does NOT end up
-    # on a replica without a connector 
-    for i in range(4):
-        proxy, text, err = proxyGet(kwargs, 'nxt_agent1', 'https://kismis.org',
-                                    "I am Nextensio agent nxt_kismis_ONE", None) 
+    # to do warmup loads till the loadbalancing looks steady
+    replicas = replicasOf(devices, 'default')
+    warmUp(kwargs, 'nxt_agent1', 'https://foobar.com', replicas)
+    checkBalance(kwargs, 'nxt_agent1', 'https://foobar.com', replicas, LB_REQUESTS)
+
+    # Also access kismis multiple times from agent1 and agent2 and ensure it works. kismis
+    # has two replicas but only one connector, so here we are trying to ensure that the
+    # kismis access does NOT end up on a replica without a connector. All of them at once
+    gets = [('nxt_agent1', 'https://kismis.org', "I am Nextensio agent nxt_kismis_ONE", None)] * 4 + \
+           [('nxt_agent2', 'https://kismis.org', "I am Nextensio agent nxt_kismis_TWO", None)] * 4
+    failures = ["agent1 kismis_ONE fail"] * 4 + ["agent2 kismis_TWO fail"] * 4
+    for (proxy, text, err), failure in zip(proxyGetMany(kwargs, gets), failures):
         if err == True:
             quit_error(text)
         if proxy != True:
-            print("agent1 kismis_ONE fail")
+            print(failure)
             quit_error(text)
 
-    for i in range(4):
-        proxy, text, err = proxyGet(kwargs, 'nxt_agent2', 'https://kismis.org',
-                                    "I am Nextensio agent nxt_kismis_TWO", None) 
-        if err == True:
-            quit_error(text)
-        if proxy != True:
-            print("agent2 kismis_TWO fail")
-            quit_error(text)
-
-    try:
-        out, err = docker_run("nxt_default1", "curl http://127.0.0.1/server-status?auto", None)
-        m = re.search(r'Total Accesses: ([0-9]+)', out)
-        if not m:
-            quit_error("Bad lighthttpd stats %s" % out)
-        def1_new = int(m[1])
-        out, err = docker_run("nxt_default2", "curl http://127.0.0.1/server-status?auto", None)
-        m = re.search(r'Total Accesses: ([0-9]+)', out)
-        if not m:
-            quit_error("Bad lighthttpd stats %s" % out)
-        def2_new = int(m[1])
-    except Exception as e:
-        quit_error("Exception %s" % e)
-
-    # The http access to read the stats (the server-status access) itself adds
-    # a count of 1 to the Total Accesses ! And then each access is incrementing the Total Accesses
-    # count in a wierd way - the first one will increment by one access, next one by two etc..,
-    # I dont know what is lighthttpd logic there. So its hard to put an accurate check here
-    # on the counts and lighthttpd counts keep changing with a new release, we need some other
-    # mechanism to track the counts. So for now just ensure that both servers got accesses
-    # more or less close to each other
-    
-    delta1 = def1_new - def1
-    delta2 = def2_new - def2
-    if (delta1 - delta2 > 2) or (delta2 - delta1 > 2): 
-        quit_error("Mismatching default counts %d / %d, %d / %d" % (def1, def1_new, def2, def2_new))
-
 # This aetest sections in this class is executed at the very beginning BEFORE
 # any of the actual test cases run. So we have all the environment loading and
 # initializations etc.. here
@@ -586,6 +944,11 @@ class CommonSetup(aetest.CommonSetup):
         global token
         global api_instance
 
+        if fakes.fake_mode():
+            fakes.install()
+            api_instance = fakes.FakeControllerApi()
+            return
+
         token = runCmd("go run ./pkce.go https://dev-635657.okta.com").strip()
         if token == "":
             print('Cannot get access token, exiting')
@@ -596,6 +959,9 @@ class CommonSetup(aetest.CommonSetup):
         config = swagger_client.Configuration()
         config.verify_ssl = False
         config.host = "https://" + os.getenv('ctrl_ip') + ":8080/api/v1"
+        # All the controller calls share the one api client, keep enough connections in
+        # its pool for the ones we make in parallel
+        config.connection_pool_maxsize = 32
         api_instance = swagger_client.DefaultApi(swagger_client.ApiClient(config))
         api_instance.api_client.set_default_header("Authorization", "Bearer " + token)
 
@@ -619,32 +985,76 @@ class CommonSetup(aetest.CommonSetup):
     @ aetest.subsection
     def verifyTestbed(self,
                       testbed):
+        # NXT_RUN_TIMEOUT (seconds) puts a limit on all the waiting done in the whole run
+        waits.set_deadline(os.getenv('NXT_RUN_TIMEOUT'))
         self.loadEnv()
         self.parseTestbed(testbed)
+        # Setting NXT_PERSISTENT_EXEC keeps one exec session open per pod instead
+        # of opening a new exec stream for every command we run in the pod
+        persistent = os.getenv('NXT_PERSISTENT_EXEC') != None
         for d in testbed.devices:
             testbed.devices[d].connect(alias='shell', via='container')
             if 'consul' in d:
                 testbed.devices[d].shell.configure(
-                    namespace='consul-system', container='')
+                    namespace='consul-system', container='', persistent=persistent)
             else:
                 testbed.devices[d].shell.configure(
-                    namespace="nxt-"+tenant, container='minion')
+                    namespace="nxt-"+tenant, container='minion', persistent=persistent)
 
 
 class CommonCleanup(aetest.CommonCleanup):
 
     @ aetest.subsection
     def cleanup(self):
+        consul.close_all()
+        exec_stats.dump()
+        waits.dump()
+        dumpWarmups()
         logger.info('Cleanup done')
 
 
+# The placement last pushed to the controller and verified for each user/bundle name.
+# Only the users and bundles whose placement is different from that are pushed again,
+# and only their containers need a restart and only their onboarding and consul entries
+# need checking. A pushed placement is pending till the caller has checked the onboarding
+# and consul entries and calls placementsVerified(), so if a check fails (or the testcase
+# is aborted) the next testcase with the same placement does it all over again
+
+placed = {}
+pending = {}
+
+def placementOf(spec):
+    return (spec['agent'], spec['cluster'], spec['pod'], spec['service'])
+
+# Returns the specs whose placement changed
 def placeAndVerifyAgents(devices, specs):
+    latest = {}
     for spec in specs:
-        gateway = spec['cluster'] + '.nextensio.net'
-        if spec['agent'] == True:
-            config_user(spec['name'], spec['service'], gateway,  spec['pod'])
+        latest[spec['name']] = spec
+    names = [name for name, spec in latest.items() if placed.get(name) != placementOf(spec)]
+    changed = [spec for spec in specs if spec['name'] in names]
+    logger.info("Placement changed for %s" % names)
+    # Whatever happens next, the controller no longer has the verified placement
+    pending.clear()
+    for name in names:
+        placed.pop(name, None)
+
+    results = pushPlacements(changed)
+    failed = []
+    for name, result in results.items():
+        if result['error'] != None:
+            failed.append("%s (%s)" % (name, result['error']))
         else:
-            config_bundle(spec['name'], spec['service'], gateway, spec['pod'])
+            pending[name] = placementOf(latest[name])
+            logger.info("Placement of %s pushed in %.3f seconds" % (name, result['time']))
+    if failed:
+        quit_error("Placement failed for %s" % ', '.join(failed))
+    return changed
+
+def placementsVerified(changed):
+    for spec in changed:
+        if spec['name'] in pending:
+            placed[spec['name']] = pending.pop(spec['name'])
 
 class Connector2Connector(aetest.Testcase):
     '''Agents and connectors back to their very first placement.
@@ -669,13 +1079,16 @@ class Connector2Connector(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR2POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
 
     @ aetest.test
     def basicConn2Conn(self, testbed, **kwargs):
+        if fakes.fake_mode():
+            self.skipped('connector to connector needs the real curl container')
         specs = [
             {'name': USER1, 'agent': True, 'device': GW1CLUSTER+"_apod1",
              'service': '', 'cluster': GW1CLUSTER, 'pod': 1},
@@ -696,11 +1109,9 @@ class Connector2Connector(aetest.Testcase):
         ]
 
         # Just allow everything, we are purely testing connector 2 connector connectivity, thats about it
-        increments = {'user': 0, 'bundle': 0, 'route': 0, 'policy': 0}
-        versions = getAllOpaVersions(testbed.devices, specs, {}, increments)
+        opaBaseline(testbed.devices, specs)
         conn2conn_policy()
-        increments = {'user': 0, 'bundle': 0, 'route': 0, 'policy': 1}
-        versions = getAllOpaVersions(testbed.devices, specs, versions['ref'], increments)
+        opaSync(testbed.devices, specs)
         c2c = os.getenv("nxt_conn2conn")
         subprocess.check_output("docker exec -it  curl sh -c \"echo 127.0.0.1 localhost > /etc/hosts\"", shell=True)
         subprocess.check_output("docker exec -it  curl sh -c \"echo %s kismis.org >> /etc/hosts\"" % c2c, shell=True)
@@ -717,11 +1128,9 @@ class Connector2Connector(aetest.Testcase):
         subprocess.check_output("docker exec -it  curl sh -c \"echo 1.1.1.1 kismis.org >> /etc/hosts\"", shell=True)
 
         # Restore the original policies
-        increments = {'user': 0, 'bundle': 0, 'route': 0, 'policy': 0}
-        versions = getAllOpaVersions(testbed.devices, specs, {}, increments)
+        opaBaseline(testbed.devices, specs)
         config_policy()
-        increments = {'user': 0, 'bundle': 0, 'route': 0, 'policy': 1}
-        versions = getAllOpaVersions(testbed.devices, specs, versions['ref'], increments)
+        opaSync(testbed.devices, specs)
 
     @ aetest.cleanup
     def cleanup(self):
@@ -752,10 +1161,11 @@ class Agent2PodsConnector3PodsClusters2LoadBalance(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR2POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
 
     @ aetest.test
     def basicConnectivity(self, testbed, **kwargs):
@@ -779,6 +1189,35 @@ class Agent2PodsConnector3PodsClusters2LoadBalance(aetest.Testcase):
         ]
         basicLoadbalancing(kwargs, specs, testbed.devices)
 
+    @ aetest.test
+    def loadBaseline(self, testbed, **kwargs):
+        if os.getenv('NXT_LOAD') == None:
+            self.skipped('load runs only with NXT_LOAD set')
+        specs = [
+            {'name': USER1, 'agent': True, 'device': GW1CLUSTER+"_apod1",
+                'service': '', 'cluster': GW1CLUSTER, 'pod': 1},
+            {'name': USER2, 'agent': True, 'device': GW1CLUSTER+"_apod2",
+                'service': '', 'cluster': GW1CLUSTER, 'pod': 2},
+            {'name': CNCTR3, 'agent': False, 'device': GW2CLUSTER+"_cpod3-0",
+             'service': 'nextensio-default-internet', 'cluster': GW2CLUSTER, 'pod': CNCTR3POD},
+            {'name': CNCTR1, 'agent': False, 'device': GW2CLUSTER+"_cpod1-0",
+             'service': 'v1.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR1POD},
+            {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-0",
+             'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR2POD},
+            {'name': CNCTR3, 'agent': False, 'device': GW2CLUSTER+"_cpod3-1",
+             'service': 'nextensio-default-internet', 'cluster': GW2CLUSTER, 'pod': CNCTR3POD},
+            {'name': CNCTR1, 'agent': False, 'device': GW2CLUSTER+"_cpod1-1",
+             'service': 'v1.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR1POD},
+            {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
+             'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR2POD}
+        ]
+        defaultPolicies(testbed.devices, specs)
+        runLoad(kwargs, [
+            ('nxt_agent1', 'default', 'https://foobar.com', "I am Nextensio agent nxt_default"),
+            ('nxt_agent1', 'kismis', 'https://kismis.org', "I am Nextensio agent nxt_kismis_ONE"),
+            ('nxt_agent2', 'default', 'https://foobar.com', "I am Nextensio agent nxt_default"),
+            ('nxt_agent2', 'kismis', 'https://kismis.org', "I am Nextensio agent nxt_kismis_TWO")])
+
     @ aetest.cleanup
     def cleanup(self):
         return
@@ -809,10 +1248,11 @@ class Agent2PodsConnector3PodsClusters2(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR2POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
 
     @ aetest.test
     def basicConnectivity(self, testbed, **kwargs):
@@ -859,10 +1299,11 @@ class Agent2PodsConnector3PodsClusters2(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW1CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW1CLUSTER, 'pod': CNCTR2POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
         basicAccessSanity(kwargs, specs, testbed.devices)
 
     @ aetest.test
@@ -890,10 +1331,11 @@ class Agent2PodsConnector3PodsClusters2(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR1POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
         basicAccessSanity(kwargs, specs, testbed.devices)
         # And now go back to the original configuration of this test case
         specs = [
@@ -914,10 +1356,11 @@ class Agent2PodsConnector3PodsClusters2(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR2POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
         basicAccessSanity(kwargs, specs, testbed.devices)
 
     @ aetest.cleanup
@@ -951,10 +1394,11 @@ class Agent2PodsConnector3PodsClustersMixed(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR3POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
 
     @ aetest.test
     def basicConnectivity(self, testbed, **kwargs):
@@ -1003,10 +1447,11 @@ class Agent2PodsConnector3PodsClustersMixed(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW1CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW1CLUSTER, 'pod': CNCTR1POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
         basicAccessSanity(kwargs, specs, testbed.devices)
         # And now go back to the original configuration of this test case
         specs = [
@@ -1027,10 +1472,11 @@ class Agent2PodsConnector3PodsClustersMixed(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR3POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
         basicAccessSanity(kwargs, specs, testbed.devices)
 
     @ aetest.test
@@ -1059,10 +1505,11 @@ class Agent2PodsConnector3PodsClustersMixed(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW1CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW1CLUSTER, 'pod': CNCTR1POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
         basicAccessSanity(kwargs, specs, testbed.devices)
 
         # And now go back to original configuration of this test case
@@ -1084,10 +1531,11 @@ class Agent2PodsConnector3PodsClustersMixed(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR3POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
         basicAccessSanity(kwargs, specs, testbed.devices)
 
     @ aetest.cleanup
@@ -1121,10 +1569,11 @@ class Agent1PodsConnector3PodsClustersMixed(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW1CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW1CLUSTER, 'pod': CNCTR3POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
 
     @ aetest.test
     def basicConnectivity(self, testbed, **kwargs):
@@ -1171,10 +1620,11 @@ class Agent1PodsConnector3PodsClustersMixed(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR1POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
         basicAccessSanity(kwargs, specs, testbed.devices)
 
     @ aetest.test
@@ -1200,10 +1650,11 @@ class Agent1PodsConnector3PodsClustersMixed(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR3POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
         basicAccessSanity(kwargs, specs, testbed.devices)
 
 # The aetest.setup section in this class is executed BEFORE the aetest.test sections,
@@ -1214,19 +1665,11 @@ class Agent1PodsConnector3PodsClustersMixed(aetest.Testcase):
 def conn2conn_policy():
     with open('conn2conn.AccessPolicy','r') as file:
         rego = file.read()
-        ok = create_policy('AccessPolicy', rego)
-        while not ok:
-            logger.info('Access Policy creation failed, retrying ...')
-            time.sleep(1)
-            ok = create_policy('AccessPolicy', rego)
+        wait_for(lambda: create_policy('AccessPolicy', rego), 'Access Policy creation', kind='controller')
         
     with open('conn2conn.RoutePolicy','r') as file:
         rego = file.read()
-        ok = create_policy('RoutePolicy', rego)
-        while not ok:
-            logger.info('Route Policy creation failed, retrying ...')
-            time.sleep(1)
-            ok = create_policy('RoutePolicy', rego)
+        wait_for(lambda: create_policy('RoutePolicy', rego), 'Route Policy creation', kind='controller')
 
 class AgentConnectorSquareOne(aetest.Testcase):
     '''Agents and connectors back to their very first placement.
@@ -1251,10 +1694,11 @@ class AgentConnectorSquareOne(aetest.Testcase):
             {'name': CNCTR2, 'agent': False, 'device': GW2CLUSTER+"_cpod2-1",
              'service': 'v2.kismis.org', 'cluster': GW2CLUSTER, 'pod': CNCTR2POD}
         ]
-        placeAndVerifyAgents(testbed.devices, specs)
-        resetAgents(testbed.devices)
-        checkOnboarding(specs)
-        checkConsulDns(specs, testbed.devices)
+        changed = placeAndVerifyAgents(testbed.devices, specs)
+        resetAgents(testbed.devices, changed)
+        checkOnboarding(changed)
+        checkConsulDns(changed, testbed.devices)
+        placementsVerified(changed)
 
     def squareOneSanity(self, testbed, **kwargs):
         basicAccessSanity(kwargs, specs, testbed.devices)
@@ -1270,6 +1714,7 @@ def create_host_attr(routejson):
         pass
         return False
 
+    ledgerBump('route')
     return True
 
 def create_user_attr(userjson, userid):
@@ -1283,6 +1728,7 @@ def create_user_attr(userjson, userid):
         pass
         return False
 
+    ledgerBump('user')
     return True
 
 def create_user(uid, name, pod, gateway):
@@ -1324,6 +1770,7 @@ def create_bundle_attr(bjson):
         pass
         return False
 
+    ledgerBump('bundle')
     return True
 
 def create_policy(pid, policy):
@@ -1341,6 +1788,8 @@ def create_policy(pid, policy):
         pass
         return False
 
+    if pid in VERSIONED_POLICIES:
+        ledgerBump('policy')
     return True
 
 if __name__ == '__main__':
@@ -0,0 +1,269 @@
+import os
+import re
+import time
+import atexit
+import select
+import threading
+import subprocess
+import requests
+from containers import kube_get_pod
+
+# Watching consul service placements over the consul HTTP API, instead of exec-ing
+# dig in the consul pod over and over. The API is reached through a kubectl
+# port-forward to the consul pod which we keep running (and restart if it dies), and
+# the services are watched with consul blocking queries: a GET with ?index=N only
+# returns once something changed after index N (or the wait time passes), so a
+# change in placement reaches us as soon as consul has it, with one idle http
+# request per service in the meantime.
+#
+# One thread watches /v1/catalog/services for the list of services, and one thread
+# per service watches /v1/health/service/<name>?passing for the instances that
+# pass their health checks (which is what consul dns answers with). The pod of an
+# instance is the NextensioPod service meta or tag, or in the node meta (which is
+# where the TXT records that dig shows come from) either as NextensioPod=<pod> or
+# as a NextensioPod:<pod> key. The catalog thread owns the port-forward, its the
+# only one that (re)starts it or closes it when requests fail
+
+KUBECTL = os.getenv('NXT_KUBECTL', '/tmp/nextensio-kind/kubectl')
+CONSUL_PORT = 8500
+# How long consul holds on to a blocking query with nothing changed
+BLOCK_WAIT = '30s'
+FORWARD_TIMEOUT = 10
+FORWARDING = re.compile(r'Forwarding from 127\.0\.0\.1:([0-9]+)')
+POD_TAG = re.compile(r'NextensioPod:(\S+)')
+
+watches = {}
+watches_lock = threading.Lock()
+
+
+class PortForward(object):
+    '''PortForward
+
+    A kubectl port-forward from a random local port to a port of a pod, the pod
+    is looked up again every time the port-forward is (re)started
+    '''
+
+    def __init__(self, context, namespace, pod, port):
+        self.context = context
+        self.namespace = namespace
+        self.pod = pod
+        self.port = port
+        self.proc = None
+        self.local = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        podname = kube_get_pod(self.context, self.namespace, self.pod)
+        if not podname:
+            raise Exception("No pod %s in %s" % (self.pod, self.context))
+        proc = subprocess.Popen([KUBECTL, 'port-forward', '--context', self.context,
+                                 '-n', self.namespace, 'pod/' + podname, ':%d' % self.port],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True)
+        deadline = time.monotonic() + FORWARD_TIMEOUT
+        while time.monotonic() < deadline:
+            ready, _, _ = select.select([proc.stdout], [], [], deadline - time.monotonic())
+            if not ready:
+                break
+            line = proc.stdout.readline()
+            if not line:
+                break
+            m = FORWARDING.search(line)
+            if m:
+                self.proc = proc
+                self.local = int(m[1])
+                return
+        proc.kill()
+        proc.wait()
+        raise Exception("port-forward to %s %s failed" % (self.context, podname))
+
+    def running(self):
+        return self.proc != None and self.proc.poll() == None
+
+    # (Re)start the port-forward if its not running
+    def ensure(self):
+        with self.lock:
+            if not self.running():
+                self.start()
+
+    def url(self):
+        with self.lock:
+            if not self.running():
+                raise Exception("port-forward to %s is not running" % self.pod)
+            return 'http://127.0.0.1:%d' % self.local
+
+    def close(self):
+        with self.lock:
+            if self.proc != None:
+                self.proc.kill()
+                self.proc.wait()
+                self.proc = None
+
+
+def meta_pod(meta):
+    if meta.get('NextensioPod'):
+        return meta['NextensioPod']
+    for key in meta:
+        m = POD_TAG.search(key)
+        if m:
+            return m[1]
+    return None
+
+
+def instance_pod(entry):
+    service = entry.get('Service') or {}
+    pod = meta_pod(service.get('Meta') or {})
+    if pod:
+        return pod
+    for tag in service.get('Tags') or []:
+        m = POD_TAG.search(tag)
+        if m:
+            return m[1]
+    node = entry.get('Node') or {}
+    return meta_pod(node.get('Meta') or {})
+
+
+# Consul service names use dashes where the nextensio service names have dots
+def service_key(name):
+    return name.replace(".", "-").replace("@", "-")
+
+
+class ConsulWatch(object):
+    '''ConsulWatch
+
+    The pods of every consul service of one cluster, kept up to date with
+    blocking queries
+    '''
+
+    def __init__(self, context, namespace, pod):
+        self.forward = PortForward(context, namespace, pod, CONSUL_PORT)
+        self.cond = threading.Condition()
+        self.generation = 0
+        self.names = None
+        self.pods = {}
+        self.closed = False
+        # Fail right here if the api cant be reached at all
+        try:
+            self.forward.ensure()
+            self.get('/v1/status/leader', None)
+        except Exception as e:
+            self.forward.close()
+            raise
+        threading.Thread(target=self.watch_catalog, daemon=True).start()
+
+    def get(self, path, index, params={}):
+        query = dict(params)
+        if index != None:
+            query['index'] = index
+            query['wait'] = BLOCK_WAIT
+        resp = requests.get(self.forward.url() + path, params=query, timeout=60)
+        resp.raise_for_status()
+        return resp.json(), int(resp.headers.get('X-Consul-Index', 0))
+
+    # Blocking query loop on path, calls update with every new result. The owner of
+    # the port-forward restarts it when requests fail, the others just try again
+    def block(self, path, params, update, owner=False):
+        index = 0
+        while not self.closed:
+            try:
+                if owner:
+                    self.forward.ensure()
+                result, new = self.get(path, index, params)
+            except Exception as e:
+                if self.closed:
+                    return
+                # The port-forward or consul went away, start over a bit later
+                if owner:
+                    self.forward.close()
+                time.sleep(0.5)
+                index = 0
+                continue
+            # Consul says to start over if the index goes backwards
+            if new < index:
+                index = 0
+                continue
+            if new != index or index == 0:
+                update(result)
+            index = max(new, 1)
+
+    def changed(self):
+        self.generation += 1
+        self.cond.notify_all()
+
+    def watch_catalog(self):
+        def update(services):
+            with self.cond:
+                if self.names == None:
+                    self.names = []
+                for name in services:
+                    if name not in self.names:
+                        self.names.append(name)
+                        threading.Thread(target=self.watch_service, args=(name,), daemon=True).start()
+                self.changed()
+        self.block('/v1/catalog/services', {}, update, owner=True)
+
+    def watch_service(self, name):
+        def update(entries):
+            pods = []
+            for entry in entries:
+                pod = instance_pod(entry)
+                if pod and pod not in pods:
+                    pods.append(pod)
+            with self.cond:
+                self.pods[name] = pods
+                self.changed()
+        self.block('/v1/health/service/' + name, {'passing': '1'}, update)
+
+    def synced(self):
+        return self.names != None and all(name in self.pods for name in self.names)
+
+    # Services not (yet) in the catalog are left out, and so are services none of
+    # whose instances we could find the pod of, so that they are looked up with dig
+    def snapshot(self, services):
+        found = {}
+        for svc in services:
+            key = service_key(svc)
+            for name in self.names:
+                if service_key(name) == key or service_key(name).startswith(key + '-'):
+                    pods = found.setdefault(svc, [])
+                    for pod in self.pods[name]:
+                        if pod not in pods:
+                            pods.append(pod)
+        return {svc: pods for svc, pods in found.items() if pods}
+
+    # Returns ({service: [pods]}, generation). If generation is what the last call
+    # returned, first wait (at most timeout seconds) for something to change
+    def service_pods(self, services, generation=None, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.synced() and self.generation != generation, timeout)
+            if not self.synced():
+                return {}, generation
+            return self.snapshot(services), self.generation
+
+    def close(self):
+        self.closed = True
+        self.forward.close()
+
+
+# The watch of the consul pod of a kube context, None if the consul api cant be
+# reached (no kubectl, port-forward fails ..), and then we dont try again
+def consul_watch(context, namespace, pod):
+    key = (context, namespace, pod)
+    with watches_lock:
+        if key not in watches:
+            try:
+                watches[key] = ConsulWatch(context, namespace, pod)
+            except Exception as e:
+                watches[key] = None
+        return watches[key]
+
+
+def close_all():
+    with watches_lock:
+        for watch in watches.values():
+            if watch != None:
+                watch.close()
+        watches.clear()
+
+
+atexit.register(close_all)
@@ -1,6 +1,23 @@
 
+import os
+import json
+import time
+import shlex
+import codecs
+import struct
+import asyncio
+import threading
+import contextvars
+import concurrent.futures
 import docker
 from pyats.connections import BaseConnection
+from exec_stats import instrument
+from exec_stats import wait_outcome
+from exec_stats import match_outcome
+import exec_stats
+from waits import wait_for
+from waits import WaitTimeout
+import waits
 from kubernetes.client.configuration import Configuration
 from kubernetes.config import kube_config
 from kubernetes.client import api_client
@@ -8,30 +25,411 @@ from kubernetes.client.api import core_v1_api
 from kubernetes.stream import stream
 from kubernetes.stream.ws_client import ERROR_CHANNEL
 from kubernetes.client import AppsV1Api
+from kubernetes import watch
+try:
+    from kubernetes_asyncio import client as async_client
+    from kubernetes_asyncio import config as async_config
+    from kubernetes_asyncio.stream import WsApiClient
+except ImportError:
+    async_client = None
+
+# Kubernetes api clients are expensive to build, each one parses the kubeconfig
+# and owns its own https connection pool. So we build one per kube context and
+# share it across every connection and thread in the process, rebuilding it only
+# if the kubeconfig file itself changes underneath us
+kube_clients = {}
+kube_clients_lock = threading.Lock()
+
+
+def kube_config_files():
+    paths = os.environ.get('KUBECONFIG', kube_config.KUBE_CONFIG_DEFAULT_LOCATION)
+    return [os.path.expanduser(p) for p in paths.split(os.pathsep) if p]
+
+
+def kube_config_stamp():
+    stamp = []
+    for path in kube_config_files():
+        try:
+            st = os.stat(path)
+            stamp.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append((path, None, None))
+    return tuple(stamp)
+
+
+class KubeClient(object):
+    '''KubeClient
+
+    The CoreV1Api/AppsV1Api pair for one kube context, sharing one ApiClient
+    (and hence one pool of https connections). kubernetes.stream.stream() swaps
+    out the request method of the ApiClient it is given while it runs, so exec
+    streams get an ApiClient of their own per thread and never touch the shared one
+    '''
+
+    def __init__(self, cluster, stamp):
+        config = Configuration()
+        kube_config.load_kube_config(
+            context=cluster, client_configuration=config)
+        config.assert_hostname = False
+        # Lots of threads can be exec-ing into pods of the same cluster at once
+        config.connection_pool_maxsize = 32
+        self.cluster = cluster
+        self.stamp = stamp
+        self.config = config
+        self.client = api_client.ApiClient(configuration=config)
+        self.core = core_v1_api.CoreV1Api(self.client)
+        self.apps = AppsV1Api(self.client)
+        self.local = threading.local()
+
+    def stream_api(self):
+        api = getattr(self.local, 'api', None)
+        if api is None:
+            api = core_v1_api.CoreV1Api(
+                api_client.ApiClient(configuration=self.config))
+            self.local.api = api
+        return api
+
+
+def kube_client(cluster):
+    stamp = kube_config_stamp()
+    kc = kube_clients.get(cluster)
+    if kc and kc.stamp == stamp:
+        return kc
+    with kube_clients_lock:
+        kc = kube_clients.get(cluster)
+        if kc and kc.stamp == stamp:
+            return kc
+        kc = KubeClient(cluster, stamp)
+        kube_clients[cluster] = kc
+        return kc
+
+
+# Same idea as the kube clients, one docker client (and its pool of unix socket
+# connections) for the whole process. Container handles are cached by name, and
+# a background thread following docker events drops the cached handle as soon
+# as a container of that name is created/destroyed/renamed
+docker_state = {'client': None, 'events': None}
+docker_containers = {}
+docker_lock = threading.Lock()
+
+
+def docker_client():
+    client = docker_state['client']
+    if client and docker_state['events']:
+        return client
+    with docker_lock:
+        if not docker_state['client']:
+            docker_state['client'] = docker.from_env(max_pool_size=32)
+        if not docker_state['events']:
+            docker_containers.clear()
+            docker_state['events'] = threading.Thread(target=docker_events, daemon=True,
+                                                      args=(docker_state['client'],),
+                                                      name="docker-events")
+            docker_state['events'].start()
+        return docker_state['client']
+
+
+def docker_events(client):
+    try:
+        for event in client.events(decode=True, filters={'type': 'container'}):
+            action = event.get('Action', '')
+            if action == 'rename':
+                with docker_lock:
+                    docker_containers.clear()
+            elif action in ('create', 'destroy'):
+                name = event.get('Actor', {}).get('Attributes', {}).get('name')
+                with docker_lock:
+                    docker_containers.pop(name, None)
+    except Exception as e:
+        pass
+    # Without events we cant trust the cache anymore, the next docker_client()
+    # call will clear it and start following events again
+    with docker_lock:
+        docker_containers.clear()
+        docker_state['events'] = None
+
+
+def docker_container(cname):
+    container = docker_containers.get(cname)
+    if container:
+        return container
+    container = docker_client().containers.get(cname)
+    with docker_lock:
+        docker_containers[cname] = container
+    return container
+
+
+def docker_exists(cname):
+    if cname in fake_containers:
+        return True
+    try:
+        docker_container(cname)
+        return True
+    except Exception as e:
+        pass
+        return False
+
+
+# The ip address of a container on a docker network, None if we cant find one
+def docker_ip(cname, network='kind'):
+    if cname in fake_containers:
+        return None
+    try:
+        networks = docker_client().api.inspect_container(cname)['NetworkSettings']['Networks']
+        return networks[network]['IPAddress'] or None
+    except Exception as e:
+        pass
+        return None
+
+
+# A container is up once its running, and healthy if it has a healthcheck (docker
+# sets the health back to "starting" when the container is started). Thats not to say
+# whatever runs in it is ready, the agent/connector images have no healthcheck, for
+# them its the onboarding (see checkOnboarding) that tells us they are ready
+def docker_up(cname):
+    try:
+        state = docker_client().api.inspect_container(cname)['State']
+    except Exception as e:
+        pass
+        return False
+    health = state.get('Health')
+    return state.get('Running') == True and (health == None or health.get('Status') == 'healthy')
+
+
+def docker_wait_up(cname, timeout=None):
+    try:
+        return wait_for(lambda: docker_up(cname), "container %s running" % cname,
+                        kind='docker', timeout=timeout)
+    except WaitTimeout as e:
+        return False
+
+
+# Containers simulated in-process rather than run by docker (see fakes.py),
+# container name -> object whose exec(cmd, environment) gives (output, exit code)
+fake_containers = {}
+
+
+# docker exec without looking up the container first, the docker api is happy
+# to take the container name as is
+def docker_exec(cname, cmd, environment={}):
+    fake = fake_containers.get(cname)
+    if fake:
+        output, exit_code = fake.exec(cmd, environment)
+        return output.encode(), exit_code
+    api = docker_client().api
+    exec_id = api.exec_create(cname, cmd, environment=environment)['Id']
+    output = api.exec_start(exec_id)
+    return output, api.exec_inspect(exec_id)['ExitCode']
+
+
+# Same as docker_exec, but hands back the output as a generator of chunks as and
+# when the command writes them, the exit code can be had with docker_exec_code()
+# once the generator is done
+def docker_exec_stream(cname, cmd, environment={}):
+    api = docker_client().api
+    exec_id = api.exec_create(cname, cmd, environment=environment)['Id']
+    return exec_id, api.exec_start(exec_id, stream=True)
+
+
+def docker_exec_code(exec_id):
+    return docker_client().api.exec_inspect(exec_id)['ExitCode']
 
 
 def docker_run(cname, cmd, expected_exit, environment={}):
     try:
-        client = docker.from_env()
-        container = client.containers.get(cname)
-        out = container.exec_run(cmd, environment=environment)
-        if out.exit_code != 0:
-            if expected_exit == None or expected_exit != out.exit_code:
-                return "docker command fail exit_code %s" % out.exit_code, True
-        return out.output.decode("utf-8"), False
+        output, exit_code = docker_exec(cname, cmd, environment)
+        if exit_code != 0:
+            if expected_exit == None or expected_exit != exit_code:
+                return "docker command fail exit_code %s" % exit_code, True
+        return output.decode("utf-8"), False
     except Exception as e:
         pass
         return "Docker command fail Exception %s" % e, True
 
 
+def pod_state(item):
+    ready = False
+    created = 0
+    if item.metadata.creation_timestamp:
+        created = item.metadata.creation_timestamp.timestamp()
+    for c in item.status.conditions or []:
+        if c.type == 'Ready' and c.status == 'True':
+            ready = True
+    return {'name': item.metadata.name,
+            'uid': item.metadata.uid,
+            'labels': item.metadata.labels or {},
+            'phase': item.status.phase,
+            'ready': ready,
+            'deleted': item.metadata.deletion_timestamp is not None,
+            'created': created}
+
+
+def pod_running(state):
+    return state['phase'] == 'Running' and not state['deleted']
+
+
+class KubePodIndex(object):
+    '''KubePodIndex
+
+    All the pods of one namespace in one cluster, kept up to date by a kubernetes
+    watch running in the background. Lookups of "the pod whose name contains X"
+    are memoized, and the memo is fixed up as watch events arrive, so a lookup
+    is a dict access and a pod restart/rename is reflected as soon as the api
+    server tells us about it
+    '''
+
+    def __init__(self, cluster, namespace):
+        self.cluster = cluster
+        self.namespace = namespace
+        self.pods = {}
+        self.matches = {}
+        self.synced = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="podindex-%s-%s" % (cluster, namespace))
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                api = kube_client(self.cluster).core
+                ret = api.list_namespaced_pod(self.namespace)
+                with self.cond:
+                    self.pods = {}
+                    for item in ret.items:
+                        self.pods[item.metadata.name] = pod_state(item)
+                    self.matches = {}
+                    self.synced = True
+                    self.cond.notify_all()
+                w = watch.Watch()
+                for event in w.stream(api.list_namespaced_pod, self.namespace,
+                                      resource_version=ret.metadata.resource_version,
+                                      timeout_seconds=300):
+                    # An ERROR is usually a 410 Gone for a stale resource version,
+                    # just go back and list everything again
+                    if event['type'] == 'ERROR':
+                        break
+                    self.update(event['type'], pod_state(event['object']))
+            except Exception as e:
+                with self.cond:
+                    self.synced = False
+                    self.cond.notify_all()
+                time.sleep(1)
+
+    def update(self, kind, state):
+        name = state['name']
+        with self.cond:
+            if kind == 'DELETED':
+                self.pods.pop(name, None)
+            else:
+                self.pods[name] = state
+            for key in list(self.matches):
+                if key in name or self.matches[key] == name:
+                    self.matches[key] = self.match(key)
+            self.cond.notify_all()
+
+    # Pick the pod whose name contains the given string, preferring pods that are
+    # running over ones that are coming up or going away, and the newest one if
+    # there are still many (like the old and new pod of a deployment restart)
+    def match(self, pod):
+        best = None
+        for state in self.pods.values():
+            if pod not in state['name']:
+                continue
+            if best is None:
+                best = state
+                continue
+            rank = (pod_running(state), not state['deleted'], state['created'])
+            brank = (pod_running(best), not best['deleted'], best['created'])
+            if rank > brank:
+                best = state
+        if best is None:
+            return None
+        return best['name']
+
+    def find(self, pod):
+        with self.cond:
+            if pod not in self.matches:
+                self.matches[pod] = self.match(pod)
+            return self.matches[pod]
+
+    def wait_synced(self, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.synced, timeout)
+
+    def wait_running(self, pod, timeout=None, ready=False):
+        def running():
+            name = self.find(pod)
+            if not name:
+                return None
+            state = self.pods[name]
+            if not pod_running(state) or (ready and not state['ready']):
+                return None
+            return name
+
+        with self.cond:
+            return self.cond.wait_for(running, timeout)
+
+    # The pods carrying all the labels. The watch thread changes self.pods under the
+    # lock, and the lock is reentrant so this works from inside the waits below too
+    def select(self, labels):
+        pods = []
+        with self.cond:
+            for state in self.pods.values():
+                if all(state['labels'].get(k) == v for k, v in labels.items()):
+                    pods.append(state)
+        return pods
+
+    # Wait on the watch till cond() is true, giving up after timeout seconds like
+    # waits.wait_for() does (waits.DEFAULT_TIMEOUT if None, never past the run's
+    # deadline). The wait is recorded with the other waits
+    def wait(self, cond, desc, timeout):
+        start = time.monotonic()
+        with self.cond:
+            ok = self.cond.wait_for(cond, max(0, waits.deadline_of(start, timeout) - start))
+        waits.done('kube', desc, time.monotonic() - start, bool(ok))
+        return ok
+
+    # Wait till none of the pods carrying the labels are left, not even ones
+    # that are still terminating
+    def wait_gone(self, labels, timeout=None):
+        return self.wait(lambda: not self.select(labels), "pods %s gone" % labels, timeout)
+
+    # Wait till at least count pods carrying the labels are Running and Ready,
+    # none of them being from the old set of pod uids
+    def wait_ready(self, labels, count, old=(), timeout=None):
+        def ready():
+            pods = [p for p in self.select(labels)
+                    if pod_running(p) and p['ready'] and p['uid'] not in old]
+            return len(pods) >= count
+
+        return self.wait(ready, "%d pods %s ready" % (count, labels), timeout)
+
+
+pod_indexes = {}
+pod_indexes_lock = threading.Lock()
+
+
+def kube_pod_index(cluster, namespace):
+    index = pod_indexes.get((cluster, namespace))
+    if index:
+        return index
+    with pod_indexes_lock:
+        index = pod_indexes.get((cluster, namespace))
+        if not index:
+            index = KubePodIndex(cluster, namespace)
+            pod_indexes[(cluster, namespace)] = index
+    index.wait_synced(10)
+    return index
+
+
 def kube_get_pod(cluster, namespace, pod):
     try:
-        config = Configuration()
-        kube_config.load_kube_config(
-            context=cluster, client_configuration=config)
-        config.assert_hostname = False
-        client = api_client.ApiClient(configuration=config)
-        api = core_v1_api.CoreV1Api(client)
+        index = kube_pod_index(cluster, namespace)
+        if index.synced:
+            return index.find(pod)
+        # The watch is broken/reconnecting, ask the api server directly
+        api = kube_client(cluster).core
         ret = api.list_namespaced_pod(namespace)
         podname = None
         for item in ret.items:
@@ -44,19 +442,18 @@ def kube_get_pod(cluster, namespace, pod):
         return None
 
 
+def kube_wait_pod(cluster, namespace, pod, timeout=None, ready=False):
+    try:
+        return kube_pod_index(cluster, namespace).wait_running(pod, timeout, ready)
+    except Exception as e:
+        pass
+        return None
+
+
 def kube_run(cluster, namespace, container, pod, cmd):
     try:
-        config = Configuration()
-        kube_config.load_kube_config(
-            context=cluster, client_configuration=config)
-        config.assert_hostname = False
-        client = api_client.ApiClient(configuration=config)
-        api = core_v1_api.CoreV1Api(client)
-        ret = api.list_namespaced_pod(namespace)
-        podname = None
-        for item in ret.items:
-            if pod in item.metadata.name:
-                podname = item.metadata.name
+        podname = kube_get_pod(cluster, namespace, pod)
+        api = kube_client(cluster).stream_api()
         exec_command = ['/bin/sh',
                         '-c',
                         cmd]
@@ -66,19 +463,451 @@ def kube_run(cluster, namespace, container, pod, cmd):
                       stderr=False, stdin=False,
                       stdout=True, tty=False)
         return resp
+    except Exception as e:
+        exec_stats.failed()
+        return ""
+
+
+def shell_quote(text):
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+class KubeShell(object):
+    '''KubeShell
+
+    One long lived /bin/sh exec stream into a pod. Commands are written to its
+    stdin one after the other, each one followed by a marker line carrying the
+    exit code of the command, which is how we know where its output ends. Each
+    command runs in its own sh -c so that a bad command cant take down the
+    session shell. If the pod behind the session restarts (the pod index tells
+    us its name changed) or the stream dies, we just open a new one
+    '''
+
+    def __init__(self, cluster, namespace, container, pod):
+        self.cluster = cluster
+        self.namespace = namespace
+        self.container = container
+        self.pod = pod
+        self.podname = None
+        self.resp = None
+        self.buf = ''
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        self.podname = kube_get_pod(self.cluster, self.namespace, self.pod)
+        api = kube_client(self.cluster).stream_api()
+        self.resp = stream(api.connect_get_namespaced_pod_exec, self.podname, self.namespace,
+                           container=self.container,
+                           command=['/bin/sh'],
+                           stderr=False, stdin=True,
+                           stdout=True, tty=False,
+                           _preload_content=False)
+        self.buf = ''
+
+    def close(self):
+        if self.resp:
+            try:
+                self.resp.close()
+            except Exception as e:
+                pass
+        self.resp = None
+
+    def alive(self):
+        if not self.resp or not self.resp.is_open():
+            return False
+        return self.podname == kube_get_pod(self.cluster, self.namespace, self.pod)
+
+    def roundtrip(self, cmd, timeout):
+        self.seq += 1
+        marker = '__nxt_%d_%d__' % (os.getpid(), self.seq)
+        self.resp.write_stdin("/bin/sh -c %s 2>/dev/null </dev/null; printf '\\n%s %%d\\n' $?\n" %
+                              (shell_quote(cmd), marker))
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
+        marker = '\n' + marker + ' '
+        while True:
+            start = self.buf.find(marker)
+            if start >= 0:
+                end = self.buf.find('\n', start + len(marker))
+                if end >= 0:
+                    out = self.buf[:start]
+                    code = int(self.buf[start + len(marker):end])
+                    self.buf = self.buf[end + 1:]
+                    return out, code
+            if not self.resp.is_open():
+                raise Exception("exec stream to %s closed" % self.podname)
+            if deadline and time.time() > deadline:
+                raise Exception("exec on %s timed out" % self.podname)
+            self.resp.update(timeout=1)
+            if self.resp.peek_stdout():
+                self.buf += self.resp.read_stdout()
+
+    def run(self, cmd, timeout=None):
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if not self.alive():
+                        self.close()
+                        self.connect()
+                    return self.roundtrip(cmd, timeout)
+                except Exception as e:
+                    # Whatever state the session is in is unknown now, so
+                    # never reuse it
+                    self.close()
+                    if attempt:
+                        raise
+
+
+# Streaming exec, for commands whose output we want to look at as it comes out
+# rather than after the command is done. The command is run under a shell that
+# first prints its pid, so that if we stop reading early (the pattern we are
+# looking for showed up, or we ran out of time) we can kill the command rather
+# than leave it running in the container
+MAX_LINE = 64 * 1024
+
+
+def stream_wrap(cmd):
+    if not isinstance(cmd, str):
+        cmd = ' '.join(shell_quote(c) for c in cmd)
+    return ['/bin/sh', '-c', 'echo $$; exec /bin/sh -c "$0"', cmd]
+
+
+def stream_kill_cmd(pid):
+    return "pkill -TERM -P %s; kill -TERM %s" % (pid, pid)
+
+
+# Turn a stream of bytes/str chunks into lines, holding on to at most one
+# partial line (of at most MAX_LINE characters) at any time
+def stream_lines(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    partial = ''
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        partial += chunk
+        lines = partial.split('\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line
+        if len(partial) > MAX_LINE:
+            yield partial
+            partial = ''
+    if partial:
+        yield partial
+
+
+def docker_stream(cname, cmd, environment={}, timeout=None):
+    exec_id, chunks = docker_exec_stream(cname, stream_wrap(cmd), environment)
+    lines = stream_lines(chunks)
+    pid = next(lines, '').strip()
+    done = False
+    # Killing the command ends the exec stream, which is what gets us out of
+    # a blocking read once we are past the deadline
+    timer = None
+    if timeout and pid:
+        timer = threading.Timer(timeout, docker_run, (cname, stream_kill_cmd(pid), None))
+        timer.daemon = True
+        timer.start()
+    try:
+        for line in lines:
+            yield line
+        done = True
+    finally:
+        if timer:
+            timer.cancel()
+        if not done and pid:
+            docker_run(cname, stream_kill_cmd(pid), None)
+
+
+def kube_stream(cluster, namespace, container, pod, cmd, timeout=None):
+    podname = kube_get_pod(cluster, namespace, pod)
+    api = kube_client(cluster).stream_api()
+    resp = stream(api.connect_get_namespaced_pod_exec, podname, namespace,
+                  container=container,
+                  command=stream_wrap(cmd),
+                  stderr=False, stdin=False,
+                  stdout=True, tty=False,
+                  _preload_content=False)
+    deadline = None
+    if timeout:
+        deadline = time.time() + timeout
+
+    expired = []
+
+    def chunks():
+        while resp.is_open():
+            if deadline and time.time() > deadline:
+                expired.append(True)
+                return
+            resp.update(timeout=1)
+            if resp.peek_stdout():
+                yield resp.read_stdout()
+
+    lines = stream_lines(chunks())
+    pid = next(lines, '').strip()
+    done = False
+    try:
+        for line in lines:
+            yield line
+        done = not expired
+    finally:
+        if not done and pid:
+            kube_run(cluster, namespace, container, pod, stream_kill_cmd(pid))
+        resp.close()
+
+
+# Run a command and return the match object as soon as a line of its output
+# matches the compiled pattern, killing the command at that point. Returns None
+# if the command ended (or timed out, or failed) without a match. The streams are
+# generators, so starting the command and any failure of it happen in the loop
+def match_lines(lines, pattern):
+    try:
+        for line in lines:
+            m = pattern.search(line)
+            if m:
+                return m
+        return None
+    except Exception as e:
+        exec_stats.failed()
+        return None
+    finally:
+        lines.close()
+
+
+def docker_run_until(cname, cmd, pattern, timeout=None, environment={}):
+    if cname in fake_containers:
+        def lines():
+            output, exit_code = docker_exec(cname, cmd, environment)
+            for line in output.decode().splitlines():
+                yield line
+        return match_lines(lines(), pattern)
+    return match_lines(docker_stream(cname, cmd, environment, timeout), pattern)
+
+
+def kube_run_until(cluster, namespace, container, pod, cmd, pattern, timeout=None):
+    return match_lines(kube_stream(cluster, namespace, container, pod, cmd, timeout), pattern)
+
+
+# The asyncio flavour of talking to docker, plain HTTP/1.1 to the docker api
+# over its unix socket. Connections are cheap enough on a unix socket that we
+# dont bother pooling them, each request opens and closes its own
+def docker_socket_path():
+    host = os.environ.get('DOCKER_HOST', '')
+    if host.startswith('unix://'):
+        return host[len('unix://'):]
+    return '/var/run/docker.sock'
+
+
+async def docker_read_body(reader, headers):
+    if headers.get('transfer-encoding', '') == 'chunked':
+        body = b''
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                return body
+            body += await reader.readexactly(size)
+            await reader.readline()
+    if 'content-length' in headers:
+        return await reader.readexactly(int(headers['content-length']))
+    return await reader.read()
+
+
+async def docker_api(method, path, body=None):
+    reader, writer = await asyncio.open_unix_connection(docker_socket_path())
+    try:
+        data = b''
+        if body != None:
+            data = json.dumps(body).encode()
+        writer.write(("%s %s HTTP/1.1\r\nHost: docker\r\nContent-Type: application/json\r\n"
+                      "Content-Length: %d\r\nConnection: close\r\n\r\n" % (method, path, len(data))).encode() + data)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+        body = await docker_read_body(reader, headers)
+        if status >= 400:
+            raise Exception("docker api %s %s status %d %s" % (method, path, status, body.decode(errors='replace')))
+        return body
+    finally:
+        writer.close()
+
+
+# Without a tty, exec output comes multiplexed as frames of an 8 byte header
+# (stream type, 3 pad bytes, big endian length) followed by the data
+def docker_demux(raw):
+    out = b''
+    while len(raw) >= 8:
+        size = struct.unpack('>I', raw[4:8])[0]
+        out += raw[8:8 + size]
+        raw = raw[8 + size:]
+    return out
+
+
+async def docker_exec_async(cname, cmd, environment={}):
+    if cname in fake_containers:
+        return await asyncio.get_running_loop().run_in_executor(None, docker_exec, cname, cmd, environment)
+    # Split string commands the same way docker-py does for exec_create
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+    body = {'AttachStdout': True, 'AttachStderr': True, 'Cmd': cmd,
+            'Env': ["%s=%s" % (k, v) for k, v in environment.items()]}
+    created = await docker_api('POST', '/containers/%s/exec' % cname, body)
+    exec_id = json.loads(created)['Id']
+    raw = await docker_api('POST', '/exec/%s/start' % exec_id, {'Detach': False, 'Tty': False})
+    inspect = await docker_api('GET', '/exec/%s/json' % exec_id)
+    return docker_demux(raw), json.loads(inspect)['ExitCode']
+
+
+async def docker_run_async(cname, cmd, expected_exit, environment={}):
+    try:
+        output, exit_code = await docker_exec_async(cname, cmd, environment)
+        if exit_code != 0:
+            if expected_exit == None or expected_exit != exit_code:
+                return "docker command fail exit_code %s" % exit_code, True
+        return output.decode("utf-8"), False
     except Exception as e:
         pass
+        return "Docker command fail Exception %s" % e, True
+
+
+# The asyncio flavour of talking to kubernetes uses kubernetes_asyncio if its
+# installed, the kubeconfig is parsed once per context like kube_client(). If
+# kubernetes_asyncio is not around, the sync calls are run on the default
+# executor instead so callers can still gather() them
+async_kube_configs = {}
+
+
+async def kube_config_async(cluster):
+    stamp = kube_config_stamp()
+    config = async_kube_configs.get(cluster)
+    if config and config[0] == stamp:
+        return config[1]
+    config = async_client.Configuration()
+    await async_config.load_kube_config(context=cluster, client_configuration=config)
+    config.assert_hostname = False
+    async_kube_configs[cluster] = (stamp, config)
+    return config
+
+
+async def kube_run_async(cluster, namespace, container, pod, cmd):
+    loop = asyncio.get_running_loop()
+    if not async_client:
+        # In our context, so that a failure is marked on the call we are part of
+        return await loop.run_in_executor(None, contextvars.copy_context().run,
+                                          kube_run, cluster, namespace, container, pod, cmd)
+    try:
+        podname = await loop.run_in_executor(None, kube_get_pod, cluster, namespace, pod)
+        config = await kube_config_async(cluster)
+        async with WsApiClient(configuration=config) as ws:
+            api = async_client.CoreV1Api(api_client=ws)
+            return await api.connect_get_namespaced_pod_exec(podname, namespace,
+                                                             container=container,
+                                                             command=['/bin/sh', '-c', cmd],
+                                                             stderr=False, stdin=False,
+                                                             stdout=True, tty=False)
+    except Exception as e:
+        exec_stats.failed()
         return ""
 
 
+async def kube_scale_async(cluster, namespace, deployment, replicas):
+    if not async_client:
+        api = kube_client(cluster).apps
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: api.patch_namespaced_deployment_scale(
+                name=deployment, namespace=namespace, body={"spec": {"replicas": replicas}}))
+        return
+    config = await kube_config_async(cluster)
+    async with async_client.ApiClient(configuration=config) as client:
+        api = async_client.AppsV1Api(client)
+        await api.patch_namespaced_deployment_scale(
+            name=deployment, namespace=namespace, body={"spec": {"replicas": replicas}})
+
+
+# Time a call, a call that swallowed its failure (see exec_stats.failed(), like a
+# kubernetes exec giving back "") is an error too
+def timed_call(fn, *args):
+    start = time.monotonic()
+    marks = []
+    token = exec_stats.failures.set(marks)
+    try:
+        output = fn(*args)
+        error = None
+        # DockerConnection.execute gives back (output, error) like docker_run
+        if isinstance(output, tuple):
+            output, err = output
+            if err:
+                error = output
+    except Exception as e:
+        output = None
+        error = "Exception %s" % e
+    finally:
+        exec_stats.failures.reset(token)
+    if error == None and marks:
+        error = "failed (%s)" % marks[0]
+    return {'output': output, 'error': error, 'time': time.monotonic() - start}
+
+
+# Make many calls at once, calls is {key: (function, args...)}. At most workers
+# calls are in flight at any time, and we give up waiting after timeout seconds.
+# What comes back is {key: {'output', 'error', 'time'}}, calls that didnt finish
+# in time have 'deadline exceeded' as their error (the call itself cant be pulled
+# back and will finish in the background)
+def run_many(calls, workers=8, timeout=None):
+    results = {}
+    if not calls:
+        return results
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(calls)))
+    futures = {}
+    start = time.monotonic()
+    for key, call in calls.items():
+        futures[pool.submit(timed_call, *call)] = key
+    done, pending = concurrent.futures.wait(futures, timeout=timeout)
+    for f in done:
+        results[futures[f]] = f.result()
+    for f in pending:
+        f.cancel()
+        results[futures[f]] = {'output': None, 'error': 'deadline exceeded',
+                               'time': time.monotonic() - start}
+    pool.shutdown(wait=False)
+    return results
+
+
+# Run commands on many devices at once, commands is {device name: command}
+def execute_many(devices, commands, workers=8, timeout=None):
+    calls = {}
+    for d, command in commands.items():
+        calls[d] = (devices[d].shell.execute, command)
+    return run_many(calls, workers, timeout)
+
+
+# Restart many devices (docker or kubernetes) at once, waiting for each one to be
+# back up, the 'output' of each device is its time to ready in seconds
+def restart_many(devices, names, workers=8, timeout=None):
+    calls = {}
+    for d in names:
+        calls[d] = (devices[d].shell.restart, True, timeout)
+    results = run_many(calls, workers, timeout)
+    for r in results.values():
+        if r['error'] == None and r['output'] == None:
+            r['error'] = 'not ready'
+    return results
+
+
 class DockerConnection(BaseConnection):
     '''DockerConnection
 
     Implementation of docker exec -it <container> <command>
     '''
 
-    nxt = {}
-
     def __init__(self, *args, **kwargs):
         '''__init__
 
@@ -87,6 +916,7 @@ class DockerConnection(BaseConnection):
 
         # instantiate parent BaseConnection
         super().__init__(*args, **kwargs)
+        self.nxt = {}
 
     def connect(self):
         '''connect
@@ -113,6 +943,7 @@ class DockerConnection(BaseConnection):
         '''
         return
 
+    @instrument('execute')
     def execute(self, command):
         '''execute
 
@@ -120,27 +951,79 @@ class DockerConnection(BaseConnection):
         be executed, and return back to prompt.
         '''
 
-        return docker_run(self.connection_info['name'], command)
+        return docker_run(self.connection_info['name'], command, None)
+
+    def execute_stream(self, command, timeout=None):
+        '''execute_stream
+
+        like execute, but yields the output a line at a time as the command
+        produces it. Closing the generator early kills the command
+        '''
+        return docker_stream(self.connection_info['name'], command, timeout=timeout)
+
+    @instrument('execute', match_outcome)
+    def execute_until(self, command, pattern, timeout=None):
+        '''execute_until
+
+        run the command till a line of its output matches pattern, and return
+        the match (or None)
+        '''
+        return docker_run_until(self.connection_info['name'], command, pattern, timeout)
 
     def configure(self, *args, **kwargs):
         for k, v in kwargs.items():
             self.nxt[k] = v
 
+    @instrument('stop')
     def stop(self):
-        client = docker.from_env()
-        container = client.containers.get(self.connection_info['name'])
-        container.kill()
+        docker_container(self.connection_info['name']).kill()
 
-    def start(self):
-        client = docker.from_env()
-        container = client.containers.get(self.connection_info['name'])
-        container.start()
+    # With wait=True, start/restart return only after the container is up (see
+    # docker_up) or timeout seconds, whichever is first. They then return how long
+    # that took, or None if we timed out
+    @instrument('start', wait_outcome)
+    def start(self, wait=False, timeout=None):
+        start = time.monotonic()
+        docker_container(self.connection_info['name']).start()
+        if not wait:
+            return
+        if not docker_wait_up(self.connection_info['name'], timeout):
+            return None
+        return time.monotonic() - start
 
-    def restart(self):
-        client = docker.from_env()
-        container = client.containers.get(self.connection_info['name'])
+    @instrument('restart', wait_outcome)
+    def restart(self, wait=False, timeout=None):
+        start = time.monotonic()
+        container = docker_container(self.connection_info['name'])
         container.kill()
         container.start()
+        if not wait:
+            return
+        if not docker_wait_up(self.connection_info['name'], timeout):
+            return None
+        return time.monotonic() - start
+
+    @instrument('execute')
+    async def aexecute(self, command):
+        '''aexecute
+
+        asyncio version of execute()
+        '''
+        return await docker_run_async(self.connection_info['name'], command, None)
+
+    @instrument('stop')
+    async def astop(self):
+        await docker_api('POST', '/containers/%s/kill' % self.connection_info['name'])
+
+    @instrument('start')
+    async def astart(self):
+        await docker_api('POST', '/containers/%s/start' % self.connection_info['name'])
+
+    # Not through astop/astart, so the restart is recorded once
+    @instrument('restart')
+    async def arestart(self):
+        await docker_api('POST', '/containers/%s/kill' % self.connection_info['name'])
+        await docker_api('POST', '/containers/%s/start' % self.connection_info['name'])
 
 
 class KubernetesConnection(BaseConnection):
@@ -158,6 +1041,7 @@ class KubernetesConnection(BaseConnection):
         # instantiate parent BaseConnection
         super().__init__(*args, **kwargs)
         self.nxt = {}
+        self.shell = None
 
     def connect(self):
         '''connect
@@ -184,6 +1068,7 @@ class KubernetesConnection(BaseConnection):
         '''
         return
 
+    @instrument('execute')
     def execute(self, command):
         '''execute
 
@@ -192,51 +1077,145 @@ class KubernetesConnection(BaseConnection):
         '''
 
         cluster, pod = self.details()
+        if self.nxt.get('persistent'):
+            return self.persistent_run(command)
         return kube_run(cluster, self.nxt['namespace'], self.nxt['container'], pod, command)
 
+    # Run the command through the persistent session of the pod
+    def persistent_run(self, command):
+        try:
+            out, code = self.session().run(command)
+            return out
+        except Exception as e:
+            exec_stats.failed()
+            return ""
+
+    def execute_stream(self, command, timeout=None):
+        '''execute_stream
+
+        like execute, but yields the output a line at a time as the command
+        produces it. Closing the generator early kills the command
+        '''
+        cluster, pod = self.details()
+        return kube_stream(cluster, self.nxt['namespace'], self.nxt['container'], pod, command, timeout)
+
+    @instrument('execute', match_outcome)
+    def execute_until(self, command, pattern, timeout=None):
+        '''execute_until
+
+        run the command till a line of its output matches pattern, and return
+        the match (or None)
+        '''
+        cluster, pod = self.details()
+        return kube_run_until(cluster, self.nxt['namespace'], self.nxt['container'], pod,
+                              command, pattern, timeout)
+
     def configure(self, *args, **kwargs):
         for k, v in kwargs.items():
             self.nxt[k] = v
 
+    def session(self):
+        '''session
+
+        The persistent shell used by execute() when the connection is
+        configured with persistent=True
+        '''
+        if not self.shell:
+            cluster, pod = self.details()
+            self.shell = KubeShell(cluster, self.nxt['namespace'], self.nxt['container'], pod)
+        return self.shell
+
     def details(self):
         cluster_pod = self.connection_info['name'].split(":")
         return cluster_pod[0], cluster_pod[1]
 
-    def stop(self):
+    def scale(self, replicas):
         cluster, pod = self.details()
-        config = Configuration()
-        kube_config.load_kube_config(
-            context=cluster, client_configuration=config)
-        config.assert_hostname = False
-        client = api_client.ApiClient(configuration=config)
-        api = AppsV1Api(client)
-        body = {"spec": {"replicas": 0}}
+        api = kube_client(cluster).apps
+        body = {"spec": {"replicas": replicas}}
         api.patch_namespaced_deployment_scale(
             name=pod, namespace=self.nxt['namespace'], body=body)
 
-    def start(self):
+    def selector(self):
         cluster, pod = self.details()
-        config = Configuration()
-        kube_config.load_kube_config(
-            context=cluster, client_configuration=config)
-        config.assert_hostname = False
-        client = api_client.ApiClient(configuration=config)
-        api = AppsV1Api(client)
-        body = {"spec": {"replicas": 1}}
-        api.patch_namespaced_deployment_scale(
-            name=pod, namespace=self.nxt['namespace'], body=body)
+        api = kube_client(cluster).apps
+        dep = api.read_namespaced_deployment(name=pod, namespace=self.nxt['namespace'])
+        return dep.spec.selector.match_labels
 
-    def restart(self):
+    def index(self):
         cluster, pod = self.details()
-        config = Configuration()
-        kube_config.load_kube_config(
-            context=cluster, client_configuration=config)
-        config.assert_hostname = False
-        client = api_client.ApiClient(configuration=config)
-        api = AppsV1Api(client)
-        body = {"spec": {"replicas": 0}}
-        api.patch_namespaced_deployment_scale(
-            name=pod, namespace=self.nxt['namespace'], body=body)
-        body = {"spec": {"replicas": 1}}
-        api.patch_namespaced_deployment_scale(
-            name=pod, namespace=self.nxt['namespace'], body=body)
+        return kube_pod_index(cluster, self.nxt['namespace'])
+
+    # With wait=True, stop/start/restart return only after the deployment's pods
+    # are all gone / the new pod is Ready (or timeout seconds, whichever is first),
+    # as seen by the pod index watch. They then return how long that took, or None
+    # if we timed out
+    @instrument('stop', wait_outcome)
+    def stop(self, wait=False, timeout=None):
+        start = time.monotonic()
+        self.scale(0)
+        if not wait:
+            return
+        if not self.index().wait_gone(self.selector(), timeout):
+            return None
+        return time.monotonic() - start
+
+    @instrument('start', wait_outcome)
+    def start(self, wait=False, timeout=None):
+        start = time.monotonic()
+        self.scale(1)
+        if not wait:
+            return
+        if not self.index().wait_ready(self.selector(), 1, timeout=timeout):
+            return None
+        return time.monotonic() - start
+
+    @instrument('restart', wait_outcome)
+    def restart(self, wait=False, timeout=None):
+        if not wait:
+            self.scale(0)
+            self.scale(1)
+            return
+        start = time.monotonic()
+        labels = self.selector()
+        index = self.index()
+        old = [p['uid'] for p in index.select(labels)]
+        self.scale(0)
+        if not index.wait_gone(labels, timeout):
+            return None
+        self.scale(1)
+        if timeout:
+            timeout = max(0, timeout - (time.monotonic() - start))
+        if not index.wait_ready(labels, 1, old, timeout):
+            return None
+        return time.monotonic() - start
+
+    @instrument('execute')
+    async def aexecute(self, command):
+        '''aexecute
+
+        asyncio version of execute()
+        '''
+
+        cluster, pod = self.details()
+        if self.nxt.get('persistent'):
+            return await asyncio.get_running_loop().run_in_executor(
+                None, contextvars.copy_context().run, self.persistent_run, command)
+        return await kube_run_async(cluster, self.nxt['namespace'], self.nxt['container'], pod, command)
+
+    @instrument('stop')
+    async def astop(self):
+        cluster, pod = self.details()
+        await kube_scale_async(cluster, self.nxt['namespace'], pod, 0)
+
+    @instrument('start')
+    async def astart(self):
+        cluster, pod = self.details()
+        await kube_scale_async(cluster, self.nxt['namespace'], pod, 1)
+
+    # Not through astop/astart, so the restart is recorded once
+    @instrument('restart')
+    async def arestart(self):
+        cluster, pod = self.details()
+        await kube_scale_async(cluster, self.nxt['namespace'], pod, 0)
+        await kube_scale_async(cluster, self.nxt['namespace'], pod, 1)
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import bisect
+import asyncio
+import threading
+import functools
+import contextvars
+
+# Latency of every exec/stop/start/restart we do on a device (and every local
+# subprocess we run), kept as a histogram per device, operation, command and
+# outcome. Recording a sample is a bisect and a few additions under a lock, so
+# this is always on. The whole lot is dumped as json and in prometheus text
+# format at the end of the run
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+stats = {}
+stats_lock = threading.Lock()
+
+
+# The "class" of a command is just the program being run, so that all the
+# "cat /tmp/opa_attr_versions" and all the "dig xyz SRV" execs land together
+def command_class(cmd):
+    if not isinstance(cmd, str):
+        cmd = ' '.join(cmd)
+    words = cmd.split()
+    if not words:
+        return ''
+    return os.path.basename(words[0])
+
+
+def record(device, op, cmd, outcome, duration):
+    idx = bisect.bisect_left(BUCKETS, duration)
+    key = (device, op, cmd, outcome)
+    with stats_lock:
+        entry = stats.get(key)
+        if entry == None:
+            entry = [0, 0.0, [0] * (len(BUCKETS) + 1)]
+            stats[key] = entry
+        entry[0] += 1
+        entry[1] += duration
+        entry[2][idx] += 1
+
+
+# The failures marked (see failed()) during the instrumented call in progress
+failures = contextvars.ContextVar('failures', default=None)
+
+
+# Code that swallows an error and returns something harmless (like kube_run giving
+# back "") calls this, so that the instrumented call its part of is still recorded
+# with the outcome
+def failed(outcome='error'):
+    marks = failures.get()
+    if marks != None:
+        marks.append(outcome)
+
+
+def outcome_of(ret, args, kwargs):
+    # docker style (output, error) returns
+    if isinstance(ret, tuple) and len(ret) == 2 and ret[1] == True:
+        return 'error'
+    return 'ok'
+
+
+# stop/start/restart with wait=True return None if they timed out
+def wait_outcome(ret, args, kwargs):
+    wait = args[0] if args else kwargs.get('wait', False)
+    if wait and ret == None:
+        return 'timeout'
+    return 'ok'
+
+
+# execute_until returns None if no line matched
+def match_outcome(ret, args, kwargs):
+    if ret == None:
+        return 'timeout'
+    return 'ok'
+
+
+# Decorator for the connection methods, the device is the connection name and
+# for execute-like methods the command class comes from the first argument. The
+# outcome is what outcome(return value, args, kwargs) says, unless a failure was
+# marked during the call
+def instrument(op, outcome=outcome_of):
+    def decorate(fn):
+        def details(self, args, kwargs):
+            device = self.connection_info['name']
+            if op == 'execute':
+                return device, command_class(args[0] if args else kwargs.get('command', ''))
+            return device, op
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(self, *args, **kwargs):
+                device, cmd = details(self, args, kwargs)
+                start = time.perf_counter()
+                result = 'exception'
+                marks = []
+                token = failures.set(marks)
+                try:
+                    ret = await fn(self, *args, **kwargs)
+                    result = marks[0] if marks else outcome(ret, args, kwargs)
+                    return ret
+                finally:
+                    failures.reset(token)
+                    # A failed call fails whatever call it is part of too
+                    if marks:
+                        failed(marks[0])
+                    record(device, op, cmd, result, time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            device, cmd = details(self, args, kwargs)
+            start = time.perf_counter()
+            result = 'exception'
+            marks = []
+            token = failures.set(marks)
+            try:
+                ret = fn(self, *args, **kwargs)
+                result = marks[0] if marks else outcome(ret, args, kwargs)
+                return ret
+            finally:
+                failures.reset(token)
+                if marks:
+                    failed(marks[0])
+                record(device, op, cmd, result, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+# The p-th percentile of values (in ascending order), each value counted counts[i]
+# times if counts are given (like the buckets of a histogram) or once if not. None
+# if there are no values
+def percentile(values, p, counts=None):
+    if counts == None:
+        counts = [1] * len(values)
+    total = sum(counts)
+    if total == 0:
+        return None
+    target = total * p / 100.0
+    seen = 0
+    for value, n in zip(values, counts):
+        seen += n
+        if seen >= target:
+            return value
+    return None
+
+
+def snapshot():
+    with stats_lock:
+        return {k: (v[0], v[1], list(v[2])) for k, v in stats.items()}
+
+
+def to_json():
+    devices = {}
+    for (device, op, cmd, outcome), (count, total, buckets) in sorted(snapshot().items()):
+        devices.setdefault(device, []).append({
+            'op': op, 'cmd': cmd, 'outcome': outcome,
+            'count': count, 'sum': total, 'mean': total / count,
+            # The upper bound of the bucket, None if its beyond the last bucket
+            'p50': percentile(BUCKETS + (None,), 50, buckets),
+            'p90': percentile(BUCKETS + (None,), 90, buckets),
+            'p99': percentile(BUCKETS + (None,), 99, buckets),
+            'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], buckets))})
+    return devices
+
+
+def prom_escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus():
+    name = 'nxt_exec_duration_seconds'
+    lines = ['# HELP %s Latency of exec/stop/start/restart per device' % name,
+             '# TYPE %s histogram' % name]
+    for (device, op, cmd, outcome), (count, total, buckets) in sorted(snapshot().items()):
+        labels = 'device="%s",op="%s",cmd="%s",outcome="%s"' % (
+            prom_escape(device), prom_escape(op), prom_escape(cmd), prom_escape(outcome))
+        cumulative = 0
+        for le, n in zip([str(b) for b in BUCKETS] + ['+Inf'], buckets):
+            cumulative += n
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, le, cumulative))
+        lines.append('%s_sum{%s} %f' % (name, labels, total))
+        lines.append('%s_count{%s} %d' % (name, labels, count))
+    return '\n'.join(lines) + '\n'
+
+
+# Write exec_stats.json and exec_stats.prom to the given directory (or to
+# NXT_STATS_DIR, or the current directory)
+def dump(directory=None):
+    if directory == None:
+        directory = os.getenv('NXT_STATS_DIR', '.')
+    with open(os.path.join(directory, 'exec_stats.json'), 'w') as f:
+        json.dump(to_json(), f, indent=2)
+    with open(os.path.join(directory, 'exec_stats.prom'), 'w') as f:
+        f.write(to_prometheus())
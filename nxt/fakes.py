@@ -0,0 +1,500 @@
+import os
+import re
+import time
+import threading
+import containers
+from exec_stats import instrument
+from exec_stats import wait_outcome
+from exec_stats import match_outcome
+from containers import DockerConnection
+from containers import KubernetesConnection
+from opa import VERSIONS_FILE
+
+# In-process stand-ins for the docker containers, the kubernetes pods and the
+# controller api, so that the harness itself can be run (and timed) without a
+# kind testbed. Run with NXT_FAKE=1 and the fake testbed
+#
+# NXT_FAKE=1 PYTHONPATH=$PYTHONPATH:. pyats run job sanity_jobs.py --testbed-file yamls/fake_testbed.yaml
+#
+# The world below plays back what the real system does closely enough for the
+# scripts: controller config reaches the OPA in the pods after a propagation
+# delay and bumps /tmp/opa_attr_versions, an agent/connector onboards with its
+# current placement when its container is restarted, onboarded connectors show
+# up in consul, and curl through an agent gets an answer from the connector that
+# the route and access policies pick. All delays are in seconds and can be set
+# from the environment
+#
+# NXT_FAKE_LATENCY      cost of every exec/curl (default 0.005)
+# NXT_FAKE_PROPAGATION  controller config to OPA in the pods (default 0.2)
+# NXT_FAKE_ONBOARD      container restart to onboarding log entry (default 0.2)
+# NXT_FAKE_CONSUL       onboarding to consul TXT record (default 0.2)
+# NXT_FAKE_WARMUP       how many first accesses to a bundle all go to its first
+#                       connector instead of round robin (default 0)
+
+TENANT = "nextensio"
+
+# Which user/bundle each of the agent/connector containers onboards as, and
+# the (made up) ip address it gets
+DEVICES = {
+    'nxt_agent1': 'test1@nextensio.net',
+    'nxt_agent2': 'test2@nextensio.net',
+    'nxt_default1': 'default',
+    'nxt_default2': 'default',
+    'nxt_kismis_ONE': 'v1kismis',
+    'nxt_kismis_TWO': 'v2kismis',
+}
+IPS = {name: "10.99.0.%d" % (i + 2) for i, name in enumerate(sorted(DEVICES))}
+
+
+def fake_mode():
+    return os.getenv('NXT_FAKE') != None
+
+
+def delay(name, default):
+    return float(os.getenv(name, default))
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+# The few swagger_client models the scripts build, so that fake runs work
+# even without the controller apis installed
+class UserAdd(Obj):
+    pass
+
+
+class BundleStruct(Obj):
+    pass
+
+
+class AddPolicy(Obj):
+    pass
+
+
+class FakeWorld(object):
+    '''FakeWorld
+
+    State of the simulated nextensio system
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = delay('NXT_FAKE_LATENCY', 0.005)
+        self.propagation = delay('NXT_FAKE_PROPAGATION', 0.2)
+        self.onboard_delay = delay('NXT_FAKE_ONBOARD', 0.2)
+        self.consul_delay = delay('NXT_FAKE_CONSUL', 0.2)
+        self.warmup = int(delay('NXT_FAKE_WARMUP', 0))
+        # Controller database
+        self.users = {}
+        self.bundles = {}
+        # Timestamped attribute/policy changes, playing back the ones older than
+        # the propagation delay gives what the OPA in the pods sees
+        self.ops = []
+        # uid/bid -> what the agent/connector onboarded with, and when
+        self.onboarded = {}
+        self.rr = {}
+        self.accesses = {}
+        self.ips = dict(IPS)
+
+    def sleep(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    # family is the OPA attribute version (user/bundle/route/policy) that the
+    # change bumps, if any
+    def apply(self, kind, key, value, family):
+        with self.lock:
+            self.ops.append((time.monotonic(), kind, key, value, family))
+
+    def view(self):
+        now = time.monotonic()
+        view = {'versions': {'user': 0, 'bundle': 0, 'route': 0, 'policy': 0}}
+        with self.lock:
+            for (t, kind, key, value, family) in self.ops:
+                if t + self.propagation > now:
+                    break
+                view.setdefault(kind, {})[key] = value
+                if family:
+                    view['versions'][family] += 1
+        return view
+
+    def opa_versions(self):
+        v = self.view()['versions']
+        return "USER=1.%d BUNDLE=1.%d ROUTE=1.%d POLICY=1.%d\n" % (
+            v['user'], v['bundle'], v['route'], v['policy'])
+
+    def restart(self, device):
+        uid = DEVICES.get(device)
+        if not uid:
+            return
+        with self.lock:
+            if uid in self.users:
+                user = self.users[uid]
+                entry = {'gw': user.gateway, 'connectid': "nextensio-apod" + str(user.pod)}
+            elif uid in self.bundles:
+                bundle = self.bundles[uid]
+                entry = {'gw': bundle.gateway, 'connectid': bundle.pod,
+                         'services': list(bundle.services)}
+            else:
+                return
+            entry['time'] = time.monotonic()
+            entry['device'] = device
+            self.onboarded.setdefault(uid, {})[device] = entry
+
+    def onboard_log(self, uid):
+        now = time.monotonic()
+        with self.lock:
+            entries = [e for e in self.onboarded.get(uid, {}).values()
+                       if e['time'] + self.onboard_delay <= now]
+        if not entries:
+            return Obj(result="not found", uid=uid, gw="", connectid="")
+        entry = max(entries, key=lambda e: e['time'])
+        return Obj(result="ok", uid=uid, gw=entry['gw'], connectid=entry['connectid'])
+
+    # The TXT records the consul of a cluster has for a service
+    def consul_pods(self, cluster, service):
+        now = time.monotonic()
+        pods = []
+        with self.lock:
+            for bid, devices in self.onboarded.items():
+                for entry in devices.values():
+                    if 'services' not in entry or service not in entry['services']:
+                        continue
+                    if entry['gw'] != cluster + ".nextensio.net":
+                        continue
+                    if entry['time'] + self.onboard_delay + self.consul_delay > now:
+                        continue
+                    if entry['connectid'] not in pods:
+                        pods.append(entry['connectid'])
+        return pods
+
+    def dig(self, cluster, command):
+        m = re.search(r'dig (\S+)\.nxt-\S+\.query\.consul', command)
+        if not m:
+            return ""
+        lines = [";; ANSWER SECTION:"]
+        for pod in self.consul_pods(cluster, m[1]):
+            lines.append('%s.nxt-%s.query.consul. 0 IN TXT "NextensioPod:%s"' % (m[1], TENANT, pod))
+        return "\n".join(lines) + "\n"
+
+    # The "for s in svc1 svc2 ..; do echo MARKER $s; dig $s... SRV; done" batch of digs
+    def dig_batch(self, cluster, command):
+        m = re.search(r'for s in ([^;]*); do echo (\S+) \$s; dig \$s(\S+)', command)
+        if not m:
+            return self.dig(cluster, command)
+        out = ""
+        for service in m[1].split():
+            out += "%s %s\n" % (m[2], service)
+            out += self.dig(cluster, "dig " + service + m[3])
+        return out
+
+    def online(self, uid):
+        now = time.monotonic()
+        with self.lock:
+            return [d for d, e in self.onboarded.get(uid, {}).items()
+                    if e['time'] + self.onboard_delay <= now]
+
+    def route_tag(self, view, host, user):
+        app = view.get('hostattr', {}).get(host)
+        if not app:
+            return ""
+        for attr in app['routeattrs']:
+            if user['type'] not in attr['type']:
+                continue
+            if not set(user['team']) & set(attr['team']):
+                continue
+            if not set(user['dept']) & set(attr['dept']):
+                continue
+            return attr['tag']
+        return ""
+
+    def allowed(self, view, bid, user):
+        attrs = view.get('bundleattr', {}).get(bid)
+        if 'AccessPolicy' not in view.get('policy', {}) or not attrs:
+            return True
+        match = set(user['dept']) & set(attrs['dept']) or set(user['team']) & set(attrs['team'])
+        if not match:
+            return False
+        if user['category'] == 'nonemployee':
+            return attrs.get('nonemployee') == 'allow'
+        if user['category'] == 'employee' and user['type'] in ('IC', 'manager'):
+            return user['level'] >= attrs[user['type']]
+        return False
+
+    # curl from an agent: which connector container answers, or the curl exit
+    # code if nobody does
+    def curl(self, agent, url):
+        uid = DEVICES.get(agent)
+        if not uid or not self.online(uid):
+            return None, 28
+        host = re.sub(r'^https?://', '', url).split('/')[0]
+        view = self.view()
+        user = view.get('userattr', {}).get(uid)
+        if not user:
+            return None, 35
+        if host == 'kismis.org':
+            tag = self.route_tag(view, host, user)
+            service = tag + "." + host if tag else host
+        else:
+            service = 'nextensio-default-internet'
+        with self.lock:
+            bids = [b for b, bundle in self.bundles.items() if service in bundle.services]
+        if not bids:
+            return None, 28
+        bid = bids[0]
+        if not self.allowed(view, bid, user):
+            return None, 35
+        devices = sorted(self.online(bid))
+        if not devices:
+            return None, 28
+        with self.lock:
+            n = self.rr.get(bid, 0)
+            self.rr[bid] = n + 1
+            if n < self.warmup:
+                connector = devices[0]
+            else:
+                connector = devices[n % len(devices)]
+            self.accesses[connector] = self.accesses.get(connector, 0) + 1
+        return connector, 0
+
+    def agent_by_ip(self, ip):
+        for name, addr in self.ips.items():
+            if addr == ip:
+                return name
+        return None
+
+    def server_status(self, device):
+        with self.lock:
+            # Reading the status is itself an access
+            self.accesses[device] = self.accesses.get(device, 0) + 1
+            return "Total Accesses: %d\n" % self.accesses[device]
+
+
+# Set up by install()
+world = None
+
+
+def exec_result(output, exit_code, expected_exit):
+    if exit_code != 0:
+        if expected_exit == None or expected_exit != exit_code:
+            return "docker command fail exit_code %s" % exit_code, True
+    return output, False
+
+
+def command_text(cmd):
+    if isinstance(cmd, str):
+        return cmd
+    return ' '.join(cmd)
+
+
+class FakeCurl(object):
+    '''FakeCurl
+
+    The curl container, or with gw the probe container of an agent whose
+    default route points to the agent, see proxyGet()
+    '''
+
+    def __init__(self, gw=None):
+        self.gw = gw
+
+    def exec(self, cmd, environment):
+        world.sleep()
+        text = command_text(cmd)
+        m = re.search(r'https?://([0-9.]+):8181', environment.get('https_proxy', ''))
+        if not m:
+            m = re.search(r'(?:route add default gw |--proxy https?://)([0-9.]+)', text)
+        url = re.search(r'-k (\S+)', text)
+        if not url:
+            return "", 0
+        if m:
+            gw = m[1].rstrip(';')
+        elif self.gw:
+            gw = self.gw
+        else:
+            return "", 0
+        connector, exit_code = world.curl(world.agent_by_ip(gw), url[1].rstrip(';'))
+        if exit_code != 0:
+            return "", exit_code
+        return "I am Nextensio agent %s\n" % connector, 0
+
+
+class FakeContainer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def exec(self, cmd, environment):
+        world.sleep()
+        text = command_text(cmd)
+        if 'server-status' in text:
+            return world.server_status(self.name), 0
+        return "", 0
+
+
+# Bring up the fake world, only ever called in fake mode (see CommonSetup.loadEnv),
+# importing this file has to leave the real runs alone. The containers of the world
+# are answered in-process from here on, and the environment gets the ip address of
+# each agent/connector like the kind environment file gives them
+def install():
+    global world
+    if world != None:
+        return
+    world = FakeWorld()
+    for name in DEVICES:
+        os.environ.setdefault(name, IPS[name])
+        containers.fake_containers[name] = FakeContainer(name)
+    containers.fake_containers['curl'] = FakeCurl()
+    # The probe container of each agent, see sanity_jobs.py
+    for name in DEVICES:
+        if name.startswith('nxt_agent'):
+            containers.fake_containers['curl_' + name] = FakeCurl(IPS[name])
+
+
+class FakeDockerConnection(DockerConnection):
+    '''FakeDockerConnection
+
+    DockerConnection for a container of the fake world
+    '''
+
+    @instrument('stop')
+    def stop(self):
+        world.sleep()
+
+    @instrument('start', wait_outcome)
+    def start(self, wait=False, timeout=None):
+        start = time.monotonic()
+        world.sleep()
+        world.restart(self.connection_info['name'])
+        if wait:
+            return time.monotonic() - start
+
+    @instrument('restart', wait_outcome)
+    def restart(self, wait=False, timeout=None):
+        start = time.monotonic()
+        world.sleep()
+        world.restart(self.connection_info['name'])
+        if wait:
+            return time.monotonic() - start
+
+    async def astop(self):
+        self.stop()
+
+    async def astart(self):
+        self.start()
+
+    async def arestart(self):
+        self.restart()
+
+
+class FakeKubernetesConnection(KubernetesConnection):
+    '''FakeKubernetesConnection
+
+    KubernetesConnection for a pod of the fake world, knows how to answer the
+    OPA version file and consul dig queries
+    '''
+
+    def run(self, command):
+        world.sleep()
+        cluster, pod = self.details()
+        cluster = cluster.replace("kind-", "", 1)
+        text = command_text(command)
+        if VERSIONS_FILE in text:
+            return world.opa_versions()
+        if 'consul' in pod and 'dig ' in text:
+            return world.dig_batch(cluster, text)
+        return ""
+
+    @instrument('execute')
+    def execute(self, command):
+        return self.run(command)
+
+    def execute_stream(self, command, timeout=None):
+        for line in self.run(command).splitlines():
+            yield line
+
+    @instrument('execute', match_outcome)
+    def execute_until(self, command, pattern, timeout=None):
+        for line in self.run(command).splitlines():
+            m = pattern.search(line)
+            if m:
+                return m
+        return None
+
+    async def aexecute(self, command):
+        return self.execute(command)
+
+    @instrument('stop', wait_outcome)
+    def stop(self, wait=False, timeout=None):
+        world.sleep()
+        if wait:
+            return 0
+
+    @instrument('start', wait_outcome)
+    def start(self, wait=False, timeout=None):
+        world.sleep()
+        if wait:
+            return 0
+
+    @instrument('restart', wait_outcome)
+    def restart(self, wait=False, timeout=None):
+        world.sleep()
+        if wait:
+            return 0
+
+    async def astop(self):
+        self.stop()
+
+    async def astart(self):
+        self.start()
+
+    async def arestart(self):
+        self.restart()
+
+
+def ok():
+    world.sleep()
+    return Obj(result="ok")
+
+
+class FakeControllerApi(object):
+    '''FakeControllerApi
+
+    The controller apis used by the scripts (swagger_client.DefaultApi)
+    '''
+
+    def add_host_attr(self, routejson, admin, tenant):
+        world.apply('hostattr', routejson['host'], routejson, 'route')
+        return ok()
+
+    def add_user_attr(self, userjson, admin, tenant, userid):
+        world.apply('userattr', userid, userjson, 'user')
+        return ok()
+
+    def add_bundle_attr(self, bjson, admin, tenant):
+        world.apply('bundleattr', bjson['bid'], bjson, 'bundle')
+        return ok()
+
+    # The controller only versions the access policy in OPA, not the route policy.
+    # This is the fake's own copy of that rule and not opa.VERSIONED_POLICIES,
+    # which is what the scripts expect, so a wrong expectation fails the fake runs
+    def add_policy_handler(self, add, admin, tenant):
+        family = None
+        if add.pid == 'AccessPolicy':
+            family = 'policy'
+        world.apply('policy', add.pid, add.rego, family)
+        return ok()
+
+    def add_user(self, add, admin, tenant):
+        with world.lock:
+            world.users[add.uid] = add
+        return ok()
+
+    def add_bundle(self, add, admin, tenant):
+        with world.lock:
+            world.bundles[add.bid] = add
+        return ok()
+
+    def get_user_onboard_log(self, admin, tenant, uid):
+        world.sleep()
+        return world.onboard_log(uid)
@@ -0,0 +1,10 @@
+# What the minions keep of the controller config in OPA
+
+# The file in the pods with the version of each attribute family OPA has
+VERSIONS_FILE = '/tmp/opa_attr_versions'
+
+# Only these policies bump the OPA POLICY version when changed, the route policy
+# for example does not. This is what the version ledger of the scripts expects, the
+# fake controller (fakes.py) states the rule on its own so it can catch this being
+# wrong
+VERSIONED_POLICIES = ['AccessPolicy']
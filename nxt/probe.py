@@ -0,0 +1,314 @@
+import sys
+import ssl
+import json
+import time
+import socket
+import argparse
+import threading
+import socketserver
+import http.client
+import concurrent.futures
+from urllib.parse import urlsplit
+
+# The probe daemon that runs in each agent's probe container (see sanity_jobs.py), so
+# that a probe is a request on a connection we already have open to the daemon rather
+# than a docker exec of curl. The daemon reads batches of probes as one json line
+#
+# {"probes": [{"url": .., "proxy": .., "expected": .., "timeout": ..}, ..], "reuse": false}
+#
+# runs all the probes of the batch at once, and answers with one json line
+#
+# {"results": [{"exit": .., "status": .., "body": .., "match": .., "time": ..}, ..]}
+#
+# or a load run as {"load": {"url": .., "proxy": .., "expected": .., "concurrency": ..,
+# "rate": .., "duration": .., "requests": ..}} answered with {"load": result} (see
+# run_load). exit is the exit code curl would have given for the same failure, since that is
+# what the testcases check for. With reuse, connections to the same host (via the
+# same proxy) are kept open and used again by later probes, thats off by default
+# since it changes which connector a request lands on. The same file is also the
+# client (probe_batch) and a command line fallback that does one probe
+#
+# python3 probe.py serve
+# python3 probe.py get https://foobar.com --proxy http://1.2.3.4:8181
+# python3 probe.py load https://foobar.com --concurrency 8 --rate 100 --duration 10
+
+PORT = 7000
+# curl exit codes
+CURL_RESOLVE = 6
+CURL_CONNECT = 7
+CURL_TIMEOUT = 28
+CURL_SSL = 35
+CURL_RECV = 56
+
+idle = {}
+idle_lock = threading.Lock()
+
+
+class ProbeError(Exception):
+    def __init__(self, exit_code, text):
+        super().__init__(text)
+        self.exit_code = exit_code
+
+
+def tunnel(sock, host, port, timeout):
+    sock.sendall(("CONNECT %s:%d HTTP/1.1\r\nHost: %s:%d\r\n\r\n" % (host, port, host, port)).encode())
+    reply = b""
+    while b"\r\n\r\n" not in reply:
+        data = sock.recv(4096)
+        if not data:
+            raise ProbeError(CURL_RECV, "proxy closed the connection")
+        reply += data
+    status = reply.split(b"\r\n", 1)[0].split()
+    if len(status) < 2 or status[1] != b"200":
+        raise ProbeError(CURL_RECV, "proxy CONNECT failed: %s" % reply.split(b"\r\n", 1)[0].decode())
+
+
+# A new connection, each step failing with the exit code curl would give
+def connect(parts, proxy, timeout):
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    if proxy:
+        target = urlsplit(proxy)
+        address = (target.hostname, target.port or 80)
+    else:
+        address = (parts.hostname, port)
+    try:
+        sock = socket.create_connection(address, timeout)
+    except socket.gaierror as e:
+        raise ProbeError(CURL_RESOLVE, "Could not resolve %s" % address[0])
+    except socket.timeout as e:
+        raise ProbeError(CURL_TIMEOUT, "Connection to %s timed out" % address[0])
+    except OSError as e:
+        raise ProbeError(CURL_CONNECT, "Could not connect to %s: %s" % (address[0], e))
+    try:
+        if proxy and https:
+            tunnel(sock, parts.hostname, port, timeout)
+        if https:
+            ctx = ssl.create_default_context()
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+            try:
+                sock = ctx.wrap_socket(sock, server_hostname=parts.hostname)
+            except socket.timeout as e:
+                raise ProbeError(CURL_TIMEOUT, "TLS handshake timed out")
+            except OSError as e:
+                raise ProbeError(CURL_SSL, "TLS handshake failed: %s" % e)
+    except socket.timeout as e:
+        sock.close()
+        raise ProbeError(CURL_TIMEOUT, "Proxy CONNECT timed out")
+    except Exception as e:
+        sock.close()
+        raise
+    conn = http.client.HTTPConnection(parts.hostname, port, timeout=timeout)
+    conn.sock = sock
+    return conn
+
+
+def get(url, proxy=None, timeout=5, reuse=False):
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.hostname, parts.port, proxy)
+    conn = None
+    if reuse:
+        with idle_lock:
+            if idle.get(key):
+                conn = idle[key].pop()
+    if conn == None:
+        conn = connect(parts, proxy, timeout)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    # Plain http through a proxy asks the proxy for the whole url
+    if proxy and parts.scheme == 'http':
+        path = url
+    try:
+        conn.sock.settimeout(timeout)
+        conn.request('GET', path, headers={'Host': parts.netloc, 'User-Agent': 'nxt-probe'})
+        resp = conn.getresponse()
+        body = resp.read()
+    except socket.timeout as e:
+        conn.close()
+        raise ProbeError(CURL_TIMEOUT, "Operation timed out")
+    except (OSError, http.client.HTTPException) as e:
+        conn.close()
+        raise ProbeError(CURL_RECV, "Failure receiving data: %s" % e)
+    if reuse and not resp.will_close:
+        with idle_lock:
+            idle.setdefault(key, []).append(conn)
+    else:
+        conn.close()
+    return resp.status, body.decode('utf-8', 'replace')
+
+
+def probe(spec, reuse=False):
+    start = time.monotonic()
+    result = {'exit': 0, 'status': None, 'body': ''}
+    try:
+        result['status'], result['body'] = get(spec['url'], spec.get('proxy'), spec.get('timeout', 5), reuse)
+    except ProbeError as e:
+        result['exit'] = e.exit_code
+        result['body'] = str(e)
+    except Exception as e:
+        result['exit'] = CURL_RECV
+        result['body'] = "Exception %s" % e
+    result['match'] = spec.get('expected', '') in result['body'] and result['exit'] == 0
+    result['time'] = time.monotonic() - start
+    return result
+
+
+def run_batch(request):
+    probes = request.get('probes', [])
+    if not probes:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(64, len(probes))) as pool:
+        return list(pool.map(lambda spec: probe(spec, request.get('reuse', False)), probes))
+
+
+# Send the same probe over and over from concurrency threads, at most rate probes a
+# second in all (0 for as fast as the threads can go), for duration seconds or till
+# requests probes are sent, whichever comes first. send does one probe and returns
+# its result like probe() does. Returns how many probes were sent, how long it took,
+# the latencies (in seconds, in ascending order) of the probes that matched and the
+# count of each failing exit code. Summing that up is up to the caller, so this file
+# stays a plain script that needs nothing but itself in the probe containers
+def run_load(spec, send=None):
+    if send == None:
+        send = lambda spec: probe(spec, spec.get('reuse', False))
+    concurrency = max(1, int(spec.get('concurrency', 1)))
+    rate = float(spec.get('rate', 0))
+    duration = float(spec.get('duration', 10))
+    requests = spec.get('requests')
+    lock = threading.Lock()
+    state = {'next': 0}
+    latencies = []
+    failures = {}
+    start = time.monotonic()
+    stop = start + duration
+
+    def worker():
+        while True:
+            with lock:
+                i = state['next']
+                if requests != None and i >= requests:
+                    return
+                state['next'] += 1
+            # Request i goes out no earlier than i/rate seconds after the start
+            if rate > 0:
+                pause = start + i / rate - time.monotonic()
+                if pause > 0:
+                    time.sleep(pause)
+            if time.monotonic() >= stop:
+                return
+            result = send(spec)
+            with lock:
+                if result['match']:
+                    latencies.append(result['time'])
+                else:
+                    failures[result['exit']] = failures.get(result['exit'], 0) + 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    return {'sent': len(latencies) + sum(failures.values()), 'elapsed': time.monotonic() - start,
+            'latencies': latencies,
+            # json keys have to be strings
+            'failures': {str(k): v for k, v in failures.items()}}
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if 'load' in request:
+                    reply = {'load': run_load(request['load'])}
+                else:
+                    reply = {'results': run_batch(request)}
+            except Exception as e:
+                reply = {'error': str(e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(port):
+    with Server(('0.0.0.0', port), Handler) as server:
+        server.serve_forever()
+
+
+def request(host, port, message, timeout):
+    with socket.create_connection((host, port), timeout) as sock:
+        sock.sendall((json.dumps(message) + "\n").encode())
+        reply = b""
+        while not reply.endswith(b"\n"):
+            data = sock.recv(65536)
+            if not data:
+                raise Exception("probe daemon closed the connection")
+            reply += data
+    reply = json.loads(reply)
+    if 'error' in reply:
+        raise Exception(reply['error'])
+    return reply
+
+
+# Send one batch of probes to the daemon at host, returns the result of each probe
+def probe_batch(host, probes, reuse=False, port=PORT, timeout=None):
+    if timeout == None:
+        timeout = max([p.get('timeout', 5) for p in probes] + [0]) + 5
+    return request(host, port, {'probes': probes, 'reuse': reuse}, timeout)['results']
+
+
+# Have the daemon at host run a load (see run_load), returns its summary
+def load_run(host, spec, port=PORT):
+    timeout = float(spec.get('duration', 10)) + spec.get('timeout', 5) + 5
+    return request(host, port, {'load': spec}, timeout)['load']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='cmd')
+    s = sub.add_parser('serve')
+    s.add_argument('--port', type=int, default=PORT)
+    g = sub.add_parser('get')
+    g.add_argument('url')
+    g.add_argument('--proxy', default=None)
+    g.add_argument('--max-time', type=float, default=5)
+    l = sub.add_parser('load')
+    l.add_argument('url')
+    l.add_argument('--proxy', default=None)
+    l.add_argument('--expected', default='')
+    l.add_argument('--concurrency', type=int, default=8)
+    l.add_argument('--rate', type=float, default=0)
+    l.add_argument('--duration', type=float, default=10)
+    l.add_argument('--max-time', type=float, default=5)
+    args = parser.parse_args()
+    if args.cmd == 'serve':
+        serve(args.port)
+    elif args.cmd == 'get':
+        result = probe({'url': args.url, 'proxy': args.proxy, 'timeout': args.max_time})
+        sys.stdout.write(result['body'])
+        sys.exit(result['exit'])
+    elif args.cmd == 'load':
+        result = run_load({'url': args.url, 'proxy': args.proxy, 'expected': args.expected,
+                           'concurrency': args.concurrency, 'rate': args.rate,
+                           'duration': args.duration, 'timeout': args.max_time})
+        latencies = result.pop('latencies')
+        result['ok'] = len(latencies)
+        result['rps'] = result['sent'] / result['elapsed']
+        if latencies:
+            result['mean'] = sum(latencies) / len(latencies)
+            result['max'] = latencies[-1]
+        sys.stdout.write(json.dumps(result, indent=2) + "\n")
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
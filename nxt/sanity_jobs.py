@@ -1,16 +1,67 @@
 from pyats.easypy import run
+from dotenv import dotenv_values
+from waits import wait_for
 import subprocess
+import probe
+import os
 
-def main():
+# Has the ip address of each agent (nxt_agent1=1.2.3.4 etc..), among other things
+ENVIRONMENT = '/tmp/nextensio-kind/environment'
+# The probe daemon, mounted into each agent's probe container
+PROBE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'probe.py')
+PROBE_IMAGE = 'python:3-alpine'
+PROBE_TIMEOUT = 60
+
+def addHosts(name):
+    # The ip address 1.1.1.1 is just some random IP, its not advertised anywhere, nextensio doesnt care about IP addresses
+    subprocess.check_output("docker exec -it  %s sh -c \"echo 1.1.1.1 foobar.com >> /etc/hosts\"" % name, shell=True)
+    subprocess.check_output("docker exec -it  %s sh -c \"echo 1.1.1.1 kismis.org >> /etc/hosts\"" % name, shell=True)
+
+def removeContainer(name):
     try:
-        subprocess.check_output("docker container rm curl -f", shell=True)   
+        subprocess.check_output("docker container rm %s -f" % name, shell=True)
     except:
         pass
-    # Start a curl container to run curl accesses from
-    subprocess.check_output("docker run -it --network kind --name curl -d --user 0:0 --cap-add=NET_ADMIN curlimages/curl /bin/sh", shell=True)   
-    # The ip address 1.1.1.1 is just some random IP, its not advertised anywhere, nextensio doesnt care about IP addresses
-    subprocess.check_output("docker exec -it  curl sh -c \"echo 1.1.1.1 foobar.com >> /etc/hosts\"", shell=True)   
-    subprocess.check_output("docker exec -it  curl sh -c \"echo 1.1.1.1 kismis.org >> /etc/hosts\"", shell=True)   
+
+# Start a curl container to run curl accesses from
+def startCurl(name):
+    removeContainer(name)
+    subprocess.check_output("docker run -it --network kind --name %s -d --user 0:0 --cap-add=NET_ADMIN curlimages/curl /bin/sh" % name, shell=True)
+    addHosts(name)
+
+def probeUp(ip):
+    try:
+        probe.probe_batch(ip, [], timeout=1)
+        return True
+    except Exception as e:
+        return False
+
+# Start the probe container of an agent, running the probe daemon (probe.py) with the
+# default route of the container pointing to the agent, so all its accesses go via the
+# agent. curl is installed too (before the route change, while we can still reach the
+# package mirrors), the scripts fall back to exec-ing curl if the daemon cant be reached
+def startProbe(name, gw):
+    removeContainer(name)
+    subprocess.check_output("docker run --network kind --name %s -d --user 0:0 --cap-add=NET_ADMIN -v %s:/probe.py:ro %s python3 /probe.py serve" %
+                            (name, PROBE, PROBE_IMAGE), shell=True)
+    subprocess.check_output("docker exec %s apk add --no-cache curl" % name, shell=True)
+    addHosts(name)
+    subprocess.check_output("docker exec -it  %s route add default gw %s" % (name, gw), shell=True)
+    ip = subprocess.check_output("docker inspect -f '{{.NetworkSettings.Networks.kind.IPAddress}}' %s" % name,
+                                 shell=True).decode().strip()
+    wait_for(lambda: probeUp(ip), "probe daemon in %s" % name, kind='docker', timeout=PROBE_TIMEOUT)
+
+def main():
+    # Everything is simulated in-process in fake mode (see fakes.py)
+    if os.getenv('NXT_FAKE') != None:
+        run('connectivity_checks.py')
+        return
+    startCurl("curl")
+    agents = {k: v for k, v in dotenv_values(ENVIRONMENT).items() if k.startswith('nxt_agent')}
+    for agent, ip in agents.items():
+        startProbe("curl_" + agent, ip)
     # run api launches a testscript as an individual task.
     run('connectivity_checks.py')
-    subprocess.check_output("docker container rm curl -f", shell=True)   
+    subprocess.check_output("docker container rm curl -f", shell=True)
+    for agent in agents:
+        subprocess.check_output("docker container rm curl_%s -f" % agent, shell=True)
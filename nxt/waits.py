@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import random
+import logging
+import concurrent.futures
+import exec_stats
+
+# Waiting for a condition to become true. Rather than checking once a second,
+# the condition is checked right away and then at intervals that start at a few
+# milliseconds and back off exponentially (with jitter) to at most a second, so
+# a condition that is almost there costs almost nothing, and one that takes long
+# doesnt get hammered. Every wait has a deadline (NXT_WAIT_TIMEOUT seconds by
+# default) and there can be a deadline for the whole run too (set_deadline()),
+# hitting either raises WaitTimeout instead of hanging forever. How long each
+# wait took is recorded in exec_stats and in history, dumped at the end of the run.
+# A wait can also be given state, which says what was last seen of the thing we
+# are waiting for, thats put in the still waiting logs and in the WaitTimeout
+
+logger = logging.getLogger(__name__)
+
+FIRST_INTERVAL = 0.005
+MAX_INTERVAL = 1.0
+BACKOFF = 2.0
+DEFAULT_TIMEOUT = float(os.getenv('NXT_WAIT_TIMEOUT', 600))
+# Log that we are still waiting at most this often
+LOG_INTERVAL = 5.0
+
+run_deadline = None
+history = []
+
+
+class WaitTimeout(Exception):
+    pass
+
+
+# Give up on every wait once seconds from now have passed, None for no limit
+def set_deadline(seconds):
+    global run_deadline
+    if seconds == None:
+        run_deadline = None
+    else:
+        run_deadline = time.monotonic() + float(seconds)
+
+
+def deadline_of(start, timeout):
+    if timeout == None:
+        timeout = DEFAULT_TIMEOUT
+    deadline = start + timeout
+    if run_deadline != None and run_deadline < deadline:
+        deadline = run_deadline
+    return deadline
+
+
+def done(kind, desc, elapsed, ok):
+    history.append({'kind': kind, 'desc': desc, 'time': elapsed, 'ok': ok})
+    exec_stats.record('wait', 'wait', kind, 'ok' if ok else 'timeout', elapsed)
+
+
+# What state() says was last seen, for the logs
+def seen(state, *key):
+    if state == None:
+        return ""
+    try:
+        return ", last seen %s" % (state(*key),)
+    except Exception as e:
+        return ", last seen unknown (%s)" % e
+
+
+def backoff(interval, deadline):
+    pause = interval * random.uniform(0.5, 1.0)
+    pause = min(pause, deadline - time.monotonic())
+    if pause > 0:
+        time.sleep(pause)
+    return min(interval * BACKOFF, MAX_INTERVAL)
+
+
+# Wait till cond() returns something true and return that. desc is what we are
+# waiting for (for the logs), kind groups similar waits together in the stats, and
+# state() if given says what was last seen
+def wait_for(cond, desc, kind='wait', timeout=None, state=None):
+    start = time.monotonic()
+    deadline = deadline_of(start, timeout)
+    interval = FIRST_INTERVAL
+    logged = start
+    while True:
+        value = cond()
+        now = time.monotonic()
+        if value:
+            done(kind, desc, now - start, True)
+            return value
+        if now >= deadline:
+            done(kind, desc, now - start, False)
+            raise WaitTimeout("Gave up waiting for %s after %.1f seconds%s" %
+                              (desc, now - start, seen(state)))
+        if now - logged >= LOG_INTERVAL:
+            logger.info("Waiting for %s, %.1f seconds so far%s" % (desc, now - start, seen(state)))
+            logged = now
+        interval = backoff(interval, deadline)
+
+
+# Wait for many conditions at once, conds is {key: cond}. Each round checks the
+# conditions that are not yet true, workers of them in parallel. Returns {key:
+# value} once all are true, each one's time to become true is recorded on its own.
+# state(key) if given says what was last seen for the key
+def wait_all(conds, desc, kind='wait', timeout=None, workers=1, state=None):
+    start = time.monotonic()
+    deadline = deadline_of(start, timeout)
+    interval = FIRST_INTERVAL
+    logged = start
+    pending = dict(conds)
+    values = {}
+    pool = None
+    if workers > 1 and len(pending) > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(pending)))
+    try:
+        while True:
+            if pool:
+                results = dict(zip(pending, pool.map(lambda k: pending[k](), list(pending))))
+            else:
+                results = {k: cond() for k, cond in pending.items()}
+            now = time.monotonic()
+            for k, value in results.items():
+                if value:
+                    done(kind, "%s %s" % (desc, k), now - start, True)
+                    values[k] = value
+                    del pending[k]
+            if not pending:
+                return values
+            if now >= deadline:
+                for k in pending:
+                    done(kind, "%s %s" % (desc, k), now - start, False)
+                raise WaitTimeout("Gave up waiting for %s after %.1f seconds: %s" %
+                                  (desc, now - start, '; '.join("%s%s" % (k, seen(state, k)) for k in pending)))
+            if now - logged >= LOG_INTERVAL:
+                logger.info("Waiting for %s, %.1f seconds so far: %s" %
+                            (desc, now - start, '; '.join("%s%s" % (k, seen(state, k)) for k in pending)))
+                logged = now
+            interval = backoff(interval, deadline)
+    finally:
+        if pool:
+            pool.shutdown(wait=False)
+
+
+# Write the time taken by every wait to waits.json in the given directory (or
+# NXT_STATS_DIR, or the current directory)
+def dump(directory=None):
+    if directory == None:
+        directory = os.getenv('NXT_STATS_DIR', '.')
+    with open(os.path.join(directory, 'waits.json'), 'w') as f:
+        json.dump(history, f, indent=2)